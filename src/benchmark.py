@@ -0,0 +1,26 @@
+from importlib import import_module
+import os
+import argparse
+
+
+def parse_args():
+    root = os.path.dirname(os.path.realpath(__file__))
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+    for name in sorted(os.listdir(os.path.join(root, 'benchmarks'))):
+        if name[-3:] != '.py' or name.startswith('_'):
+            continue
+        name = name[:-3]
+        module = import_module('.'.join(('benchmarks', name)))
+        if not hasattr(module, 'parse_args') and not hasattr(module, 'execute'):
+            continue
+        benchmark_parser = subparsers.add_parser(name)
+        module.parse_args(benchmark_parser)
+        benchmark_parser.set_defaults(func=module.execute)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,48 @@
+import os
+import time
+from PIL import Image
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+from common.loaders.decode import DraftLoader
+
+
+def parse_args(parser):
+    parser.add_argument('roots', type=str, nargs='+', help='Image folders to decode, e.g. data/train/real data/train/sketch')
+    parser.add_argument('--size', type=int, default=256, help='Size the images are resized to')
+    parser.add_argument('--images', type=int, default=500, help='Number of images decoded per folder')
+
+
+def list_images(root, n):
+    files = []
+    for dirpath, _, names in sorted(os.walk(root)):
+        files += [os.path.join(dirpath, name) for name in sorted(names) if name.lower().endswith(IMG_EXTENSIONS)]
+        if len(files) >= n:
+            break
+    return files[:n]
+
+
+def full_loader(path):
+    with open(path, 'rb') as f:
+        return Image.open(f).convert('RGB')
+
+
+def decode_time(loader, files, size):
+    decode = 0.
+    start = time.perf_counter()
+    for path in files:
+        t = time.perf_counter()
+        img = loader(path)
+        decode += time.perf_counter() - t
+        img.resize((size, size), 1)
+    return decode / len(files), (time.perf_counter() - start) / len(files)
+
+
+def execute(args):
+    for root in args.roots:
+        files = list_images(root, args.images)
+        full, full_total = decode_time(full_loader, files, args.size)
+        draft, draft_total = decode_time(DraftLoader(args.size), files, args.size)
+        print(f'{root} ({len(files)} images)')
+        print(f'  Full decode:  {full * 1000:.2f} ms/image, {full_total * 1000:.2f} ms/image with resize')
+        print(f'  Draft decode: {draft * 1000:.2f} ms/image, {draft_total * 1000:.2f} ms/image with resize')
+        print(f'  Speedup: {full / draft:.1f}x decode, {full_total / draft_total:.1f}x with resize')
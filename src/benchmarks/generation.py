@@ -0,0 +1,66 @@
+import time
+import torch
+
+from models.sg.model import Generator, MappingNetwork
+
+
+def parse_args(parser):
+    parser.add_argument('--img-size', type=int, default=32, help='Size of the image')
+    parser.add_argument('--bottleneck-size', type=int, default=32)
+    parser.add_argument('--max-conv-dim', type=int, default=512)
+    parser.add_argument('--batch-size', type=int, default=128, help='Images generated per pass, as in compute_fid')
+    parser.add_argument('--styles', type=int, default=10, help='Number of styles per source image')
+    parser.add_argument('--batches', type=int, default=4, help='Number of timed source batches')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def per_style(generator, mapping, data, z_trg, d_trg):
+    # Previous loop of compute_fid: the source batch is encoded again for every style
+    return torch.cat([generator(data, mapping(z, d_trg[:len(z)])) for z in z_trg.split(len(data))])
+
+
+def encode_once(generator, mapping, data, z_trg, d_trg):
+    return generator.stylize(generator.content(data), mapping(z_trg, d_trg[:len(z_trg)]))
+
+
+def timed(fn, generator, mapping, batches, d_trg, device):
+    fn(generator, mapping, *batches[0], d_trg)  # Warmup
+    synchronize(device)
+    start = time.time()
+    for data, z_trg in batches:
+        fn(generator, mapping, data, z_trg, d_trg)
+    synchronize(device)
+    return sum(len(z_trg) for _, z_trg in batches) / (time.time() - start)
+
+
+@torch.no_grad()
+def execute(args):
+    torch.manual_seed(0)
+    generator = Generator(bottleneck_size=args.bottleneck_size, bottleneck_blocks=4, img_size=args.img_size,
+                          max_conv_dim=args.max_conv_dim).to(args.device).eval()
+    mapping = MappingNetwork().to(args.device).eval()
+    d_trg = torch.zeros(args.batch_size * args.styles, dtype=torch.long, device=args.device)
+
+    def source(size):
+        data = torch.rand(size, 3, args.img_size, args.img_size, device=args.device) * 2 - 1
+        return data, torch.randn(args.styles * size, 16, device=args.device)
+
+    # Same number of images per pass: batch_size per style before, batch_size // styles sources with all styles after
+    before = timed(per_style, generator, mapping, [source(args.batch_size) for _ in range(args.batches)], d_trg,
+                   args.device)
+    after = timed(encode_once, generator, mapping,
+                  [source(args.batch_size // args.styles) for _ in range(args.batches * args.styles)], d_trg,
+                  args.device)
+
+    data, z_trg = source(args.batch_size // args.styles)
+    difference = (per_style(generator, mapping, data, z_trg, d_trg)
+                  - encode_once(generator, mapping, data, z_trg, d_trg)).abs().max()
+    print(f'Generator {args.img_size}px, {args.styles} styles per source image')
+    print(f'Encoded per style: {before:.1f} images/s')
+    print(f'Encoded once: {after:.1f} images/s ({after / before:.2f}x)')
+    print(f'Max absolute difference of the generated images: {difference:.2e}')
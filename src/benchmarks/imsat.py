@@ -0,0 +1,60 @@
+import time
+import torch
+from torch import optim
+
+from common.util import sample
+from common.loaders import images
+from models.imsat.train import define_models, contrastive_loss, compute_loss
+
+
+def parse_args(parser):
+    parser.add_argument('--dataset-loc', type=str, default='./data', help='Location of MNIST')
+    parser.add_argument('--train-batch-size', type=int, default=64, help='Batch size')
+    parser.add_argument('--h-dim', type=int, default=512, help='N hidden channels in the network')
+    parser.add_argument('--d-updates', type=int, default=4, help='N critic updates per generator update')
+    parser.add_argument('--iterations', type=int, default=200, help='Number of timed iterations')
+    parser.add_argument('--warmup', type=int, default=10, help='Number of iterations before timing')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def iterations_per_sec(args, train_loader, shape, nc):
+    models = define_models(shape, h_dim=args.h_dim, nc=nc)
+    encoder = models['classifier'].to(args.device)
+    contrastive = models['contrastive'].to(args.device)
+    optim_encoder = optim.Adam(encoder.parameters(), lr=1e-3, betas=(0., 0.99))
+    optim_contrastive = optim.Adam(contrastive.parameters(), lr=1e-3, betas=(0., 0.99))
+
+    iter1 = iter(train_loader)
+    for i in range(args.warmup + args.iterations):
+        if i == args.warmup:
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            start = time.time()
+        for _ in range(args.d_updates):
+            batchx, iter1 = sample(iter1, train_loader)
+            datax = batchx[0].float().to(args.device)
+            optim_contrastive.zero_grad()
+            ploss, nloss, gp = contrastive_loss(datax, nc, encoder, contrastive, args.device)
+            (ploss - nloss + gp).backward()
+            optim_contrastive.step()
+
+        batchx, iter1 = sample(iter1, train_loader)
+        datax = batchx[0].float().to(args.device)
+        dataxp = batchx[1].float().to(args.device)
+        optim_encoder.zero_grad()
+        dloss, closs = compute_loss(datax, dataxp, encoder, contrastive, args.device)
+        (dloss + closs).backward()
+        optim_encoder.step()
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    return args.iterations / (time.time() - start)
+
+
+def execute(args):
+    results = {}
+    for name, batch_augment in (('per-sample', False), ('batched', True)):
+        train_loader, _, _, shape, nc = images.imnist(args.dataset_loc, args.train_batch_size, None, 0,
+                                                      batch_augment=batch_augment)
+        results[name] = iterations_per_sec(args, train_loader, shape, nc)
+        print(f'{name} RandomAffine: {results[name]:.2f} it/s')
+    print(f'Speedup: {results["batched"] / results["per-sample"]:.2f}x')
@@ -0,0 +1,101 @@
+import random
+import time
+import torch
+from torch.utils import data
+from torch.utils.data.dataloader import default_collate
+
+from common.loaders.images import CondDataset, PairIndex, PairBatchSampler
+
+
+def parse_args(parser):
+    parser.add_argument('--size', type=int, default=130000, help='Number of samples in the synthetic dataset')
+    parser.add_argument('--nc', type=int, default=10, help='Number of semantic classes')
+    parser.add_argument('--samples', type=int, default=2000, help='Number of items fetched per measurement')
+    parser.add_argument('--img-size', type=int, default=32, help='Size of the synthetic images')
+    parser.add_argument('--batch-size', type=int, default=64, help='Batch size of the pair batch sampler')
+
+
+def legacy_getitem(dataset, labels_idxs, idx):
+    # Partner lookup as done before PairIndex: O(N) scan of the domains for every item
+    sample, _ = dataset.dataset[idx]
+    target = dataset.labels[idx]
+    domain = dataset.domains[idx]
+    idxs = labels_idxs[target]
+    idx2 = idxs[random.randint(0, len(idxs)-1)]
+
+    sample2, _ = dataset.dataset[idx2]
+    domain2 = dataset.domains[idx2]
+
+    idx_domain = torch.nonzero(dataset.domains == domain2, as_tuple=True)[0]
+    idxs_ds = list(set(idxs.tolist()) & set(idx_domain.tolist()))
+    idx_ds = idxs_ds[random.randint(0, len(idxs_ds)-1)]
+    sample_ds, _ = dataset.dataset[idx_ds]
+    return sample, target, domain, sample2, sample_ds, domain2
+
+
+def synthetic_dataset(size, nc, img_size):
+    half = size // 2
+    x = torch.zeros(1, 3, img_size, img_size).expand(size, -1, -1, -1)
+    y = torch.zeros(size).long()
+    dataset = CondDataset(data.TensorDataset(x[:half], y[:half]),
+                          data.TensorDataset(x[half:], y[half:]))
+    dataset.labels = torch.randint(nc, (size,))
+    dataset.pairs = PairIndex(dataset.labels, dataset.domains)
+    return dataset
+
+
+def throughput(fetch, size, samples):
+    idxs = [random.randint(0, size-1) for _ in range(samples)]
+    start = time.time()
+    for idx in idxs:
+        fetch(idx)
+    return samples / (time.time() - start)
+
+
+class CountLoads(data.Dataset):
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.loads = 0
+
+    def __getitem__(self, idx):
+        self.loads += 1
+        return self.dataset[idx]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def batch_throughput(dataset, batch_size, samples, pair_batches):
+    # Counts the images loaded by the (collated) batches, as decoding dominates on the image folders
+    dataset.dataset = CountLoads(dataset.dataset)
+    sampler = PairBatchSampler(dataset, batch_size)
+    n = 0
+    start = time.time()
+    for idxs in sampler:
+        if pair_batches:
+            dataset[idxs]
+        else:
+            default_collate([dataset[idx] for idx in idxs[0].tolist()])
+        n += idxs.shape[1]
+        if n >= samples:
+            break
+    elapsed = time.time() - start
+    loads = dataset.dataset.loads
+    dataset.dataset = dataset.dataset.dataset
+    return n / elapsed, loads * batch_size / n
+
+
+def execute(args):
+    dataset = synthetic_dataset(args.size, args.nc, args.img_size)
+    labels_idxs = [torch.nonzero(dataset.labels == label)[:, 0] for label in range(args.nc)]
+
+    before = throughput(lambda idx: legacy_getitem(dataset, labels_idxs, idx), len(dataset), args.samples)
+    after = throughput(lambda idx: dataset[idx], len(dataset), args.samples)
+    collated, loads = batch_throughput(dataset, args.batch_size, args.samples, False)
+    batched, batched_loads = batch_throughput(dataset, args.batch_size, args.samples, True)
+    print(f'Dataset size: {len(dataset)}, classes: {args.nc}')
+    print(f'Before (scan): {before:.1f} samples/sec')
+    print(f'After (index): {after:.1f} samples/sec')
+    print(f'Speedup: {after / before:.1f}x')
+    print(f'Collated items: {collated:.1f} samples/sec, {loads:.1f} image loads per batch of {args.batch_size}')
+    print(f'Pair batches: {batched:.1f} samples/sec, {batched_loads:.1f} image loads per batch of {args.batch_size}')
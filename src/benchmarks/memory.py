@@ -0,0 +1,77 @@
+import os
+import numpy as np
+from torch.utils import data
+from torchvision import datasets
+
+from common.loaders.images import SourceDataset, ArrayImageFolder
+
+
+def parse_args(parser):
+    parser.add_argument('root', type=str, help='Image folder of a SourceDataset, with one subfolder per domain')
+    parser.add_argument('--workers', type=int, default=4, help='Number of DataLoader workers')
+    parser.add_argument('--batch-size', type=int, default=64, help='Batch size')
+    parser.add_argument('--batches', type=int, default=2000, help='Number of batches loaded')
+    parser.add_argument('--decode', action='store_true', help='Also decode the images (only the paths are read otherwise)')
+
+
+def private_memory():
+    # Memory private to the process: the pages copied on write after the fork count here but not in a plain RSS
+    private = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                private += int(line.split()[1]) * 1024
+    return private
+
+
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def path_loader(path):
+    return path
+
+
+def report(batch):
+    # Collated in the worker, after its items were fetched
+    return len(batch), os.getpid(), rss(), private_memory()
+
+
+def source_dataset(root, arrays, decode):
+    """SourceDataset over the domains of `root`, with the image folders of the arrays layout (ArrayImageFolder) or
+    of the lists layout (torchvision ImageFolder). Without decode, the items are the paths of the images.
+    """
+    dataset = SourceDataset(root, device='cpu')
+    loader = None if decode else path_loader
+    folders = [os.path.join(root, domain) for domain in sorted(os.listdir(root))]
+    if arrays:
+        folders = [ArrayImageFolder(folder, loader=loader) for folder in folders]
+    else:
+        folders = [datasets.ImageFolder(folder, loader=loader or datasets.folder.default_loader) for folder in folders]
+    dataset.datasets = data.ConcatDataset(folders)
+    return dataset
+
+
+def worker_memory(dataset, args):
+    sampler = data.RandomSampler(dataset, replacement=True, num_samples=args.batch_size * args.batches)
+    loader = data.DataLoader(dataset, batch_size=args.batch_size, sampler=sampler, num_workers=args.workers,
+                             collate_fn=report)
+    first = {}
+    last = {}
+    for _, pid, rss_, private in loader:
+        first.setdefault(pid, (rss_, private))
+        last[pid] = (rss_, private)
+    rss_delta = np.mean([last[pid][0] - first[pid][0] for pid in first])
+    private_delta = np.mean([last[pid][1] - first[pid][1] for pid in first])
+    return rss_delta, private_delta, np.mean([last[pid][1] for pid in last])
+
+
+def execute(args):
+    mb = 1024 ** 2
+    for name, arrays in (('Before (lists)', False), ('After (arrays)', True)):
+        dataset = source_dataset(args.root, arrays, args.decode)
+        rss_delta, private_delta, private = worker_memory(dataset, args)
+        print(f'{name}: {len(dataset)} images, per-worker RSS delta {rss_delta / mb:.1f} MB, '
+              f'private delta {private_delta / mb:.1f} MB, private total {private / mb:.1f} MB')
+        del dataset
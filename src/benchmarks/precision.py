@@ -0,0 +1,94 @@
+import tempfile
+import time
+from argparse import ArgumentParser
+import torch
+
+from common.loaders import images
+from common.util import normalize
+from models import sg
+from models.sg.train import Solver, InputFetcher
+
+
+def parse_args(parser):
+    parser.add_argument('--dataset-loc', type=str, default='./data', help='Location of the datasets')
+    parser.add_argument('--dataset', type=str, default='mnist_svhn', choices=['mnist_svhn', 'visda'])
+    parser.add_argument('--train-batch-size', type=int, default=8, help='Batch size')
+    parser.add_argument('--img-size', type=int, default=32, help='Image size (256 for visda)')
+    parser.add_argument('--iterations', type=int, default=50, help='Number of timed iterations')
+    parser.add_argument('--warmup', type=int, default=5, help='Number of iterations before timing')
+    parser.add_argument('--fid', action='store_true', help='Also compute the FID of the translated validation images')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def model_args(args, model_path, **options):
+    # Defaults of the sg model, at the size of the images, with the options of the compared runs
+    parser = ArgumentParser()
+    sg.parse_args(parser)
+    model_args = parser.parse_args([])
+    model_args.img_size = args.img_size
+    model_args.bottleneck_size = min(model_args.bottleneck_size, args.img_size // 4)
+    model_args.device = args.device
+    model_args.model_path = model_path
+    for name, value in options.items():
+        setattr(model_args, name, value)
+    return model_args
+
+
+def train(args, batches, **options):
+    """Runs the iterations of the sg Solver from the same initialization on the same batches, with the model options
+    of the run (e.g. bf16). Returns it/s, the mean losses of the last 10 iterations and the EMA networks.
+    """
+    torch.manual_seed(0)
+    with tempfile.TemporaryDirectory() as model_path:
+        solver = Solver(model_args(args, model_path, **options))
+    losses = []
+    for i, inputs in enumerate(batches):
+        if i == args.warmup:
+            if args.device.startswith('cuda'):
+                torch.cuda.synchronize()
+            start = time.time()
+        prefixes = ['D/latent_', 'D/ref_', 'G/latent_', 'G/ref_']
+        losses.append({prefix + k: v for prefix, loss in zip(prefixes, solver.step(inputs, i)) for k, v in loss.items()})
+    if args.device.startswith('cuda'):
+        torch.cuda.synchronize()
+    speed = (len(batches) - args.warmup) / (time.time() - start)
+    last = losses[-10:]
+    return speed, {k: sum(l[k] for l in last) / len(last) for k in last[0]}, solver.nets_ema
+
+
+@torch.no_grad()
+def translate(nets_ema, inputs):
+    # Latent-guided translation to the domain of the partners, in fp32
+    s_trg = nets_ema.mapping_network(inputs.z_trg, inputs.d_src2)
+    return nets_ema.generator(inputs.x_src, s_trg)
+
+
+def execute(args):
+    train_loader, val_loader, _, _ = getattr(images, args.dataset)(args.dataset_loc, args.train_batch_size,
+                                                                   args.train_batch_size)
+    torch.manual_seed(0)
+    fetcher = InputFetcher(train_loader, 16, args.device)
+    batches = [next(fetcher) for _ in range(args.warmup + args.iterations)]
+    fetcher_val = InputFetcher(val_loader, 16, args.device)
+    val = [next(fetcher_val) for _ in range(4)]
+
+    results = {}
+    for name, bf16 in (('fp32', False), ('bf16', True)):
+        results[name] = train(args, batches, bf16=bf16)
+        print(f'{name}: {results[name][0]:.2f} it/s')
+    print(f'Speedup: {results["bf16"][0] / results["fp32"][0]:.2f}x')
+
+    print('Mean losses of the last 10 iterations (fp32 / bf16):')
+    for key, value in results['fp32'][1].items():
+        print(f'  {key}: {value:.4f} / {results["bf16"][1][key]:.4f}')
+
+    generated = {name: torch.cat([translate(result[2], inputs) for inputs in val]) for name, result in results.items()}
+    difference = (generated['fp32'] - generated['bf16']).abs().mean()
+    print(f'Mean absolute difference of the EMA translations: {difference:.4f}')
+    if args.fid:
+        from common.evaluation import fid
+        # The validation loader only loads the anchors: the partners of the target domains are loaded from their indices
+        real = normalize(torch.cat([val_loader.dataset.load(inputs.idx_src2.cpu()) for inputs in val]).to(args.device))
+        for name, x in generated.items():
+            value = fid.calculate_fid(real, normalize(x.clone()), 50, args.device, 2048)
+            print(f'FID {name}: {value:.2f}')
@@ -0,0 +1,47 @@
+import torch
+
+from common.loaders import images
+from common.util import normalize
+from models.sg.train import InputFetcher
+from .precision import train, translate
+
+
+def parse_args(parser):
+    parser.add_argument('--dataset-loc', type=str, default='./data', help='Location of the datasets')
+    parser.add_argument('--dataset', type=str, default='mnist_svhn', choices=['mnist_svhn', 'visda'])
+    parser.add_argument('--train-batch-size', type=int, default=8, help='Batch size')
+    parser.add_argument('--img-size', type=int, default=32, help='Image size (256 for visda)')
+    parser.add_argument('--r1-every', type=int, nargs='+', default=[1, 4, 16], help='Values of r1_every to compare')
+    parser.add_argument('--iterations', type=int, default=50, help='Number of timed iterations')
+    parser.add_argument('--warmup', type=int, default=5, help='Number of iterations before timing')
+    parser.add_argument('--fid', action='store_true', help='Also compute the FID of the translated validation images')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def execute(args):
+    train_loader, val_loader, _, _ = getattr(images, args.dataset)(args.dataset_loc, args.train_batch_size,
+                                                                   args.train_batch_size)
+    torch.manual_seed(0)
+    fetcher = InputFetcher(train_loader, 16, args.device)
+    batches = [next(fetcher) for _ in range(args.warmup + args.iterations)]
+    fetcher_val = InputFetcher(val_loader, 16, args.device)
+    val = [next(fetcher_val) for _ in range(4)]
+
+    results = {}
+    for k in args.r1_every:
+        results[k] = train(args, batches, r1_every=k)
+        print(f'r1_every {k}: {results[k][0]:.2f} it/s ({results[k][0] / results[args.r1_every[0]][0]:.2f}x)')
+
+    # R1 is logged as 0 on the unregularized steps: mean over the last 10 iterations only
+    print('Mean losses of the last 10 iterations (r1_every ' + ' / '.join(map(str, args.r1_every)) + '):')
+    for key in results[args.r1_every[0]][1]:
+        print(f'  {key}: ' + ' / '.join(f'{results[k][1][key]:.4f}' for k in args.r1_every))
+
+    if args.fid:
+        from common.evaluation import fid
+        # The validation loader only loads the anchors: the partners of the target domains are loaded from their indices
+        real = normalize(torch.cat([val_loader.dataset.load(inputs.idx_src2.cpu()) for inputs in val]).to(args.device))
+        for k, result in results.items():
+            generated = torch.cat([translate(result[2], inputs) for inputs in val])
+            value = fid.calculate_fid(real, normalize(generated.clone()), 50, args.device, 2048)
+            print(f'FID r1_every {k}: {value:.2f}')
@@ -0,0 +1,47 @@
+import time
+from contextlib import contextmanager
+from torchvision import datasets
+
+from common.loaders import images
+from common.loaders.integrity import SVHN
+
+
+def parse_args(parser):
+    parser.add_argument('--dataset-loc', type=str, default='./data', help='Location of the datasets')
+    parser.add_argument('--dataset', type=str, default='svhn', choices=['mnist', 'svhn', 'svhn_extra'])
+    parser.add_argument('--repeats', type=int, default=3, help='Number of timed constructions')
+
+
+@contextmanager
+def md5_every_time():
+    # Restores the verification of torchvision: the archives are hashed on every construction
+    check, download = SVHN._check_integrity, SVHN.download
+    SVHN._check_integrity, SVHN.download = datasets.SVHN._check_integrity, datasets.SVHN.download
+    try:
+        yield
+    finally:
+        SVHN._check_integrity, SVHN.download = check, download
+
+
+def timed(fn, repeats):
+    start = time.time()
+    for _ in range(repeats):
+        fn()
+    return (time.time() - start) / repeats
+
+
+def execute(args):
+    dataset = getattr(images, args.dataset)
+    train = lambda **kwargs: dataset(args.dataset_loc, 64, 64, **kwargs)
+    evaluation = lambda **kwargs: dataset(args.dataset_loc, 1, 32, **kwargs)[2]
+
+    train()  # Downloads the dataset and writes the verification stamps
+    with md5_every_time():
+        train_before = timed(train, args.repeats)
+        evaluation_before = timed(evaluation, args.repeats)
+    train_after = timed(train, args.repeats)
+    evaluation_after = timed(lambda: evaluation(splits=('test',)), args.repeats)
+
+    print(f'Dataset {args.dataset}')
+    print(f'main.py loaders: {train_before:.2f}s before, {train_after:.2f}s after')
+    print(f'evaluate.py loader: {evaluation_before:.2f}s before, {evaluation_after:.2f}s after (test split only)')
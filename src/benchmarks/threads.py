@@ -0,0 +1,80 @@
+import os
+import time
+from torch.utils import data
+from torchvision import transforms
+
+from common.loaders.images import image_folder, threaded_loader
+
+
+def parse_args(parser):
+    parser.add_argument('root', type=str, help='Image folder, e.g. data/train/real')
+    parser.add_argument('--image-format', type=str, default='folder', choices=['folder', 'memmap', 'draft'])
+    parser.add_argument('--batch-size', type=int, default=32, help='Batch size')
+    parser.add_argument('--batches', type=int, default=100, help='Number of batches loaded')
+    parser.add_argument('--workers', type=int, default=8, help='Number of worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='Number of decoding threads of the threaded loader')
+
+
+def children(pid):
+    pids = []
+    for tid in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{tid}/children') as f:
+            pids += [int(child) for child in f.read().split()]
+    return pids + [p for child in pids for p in children(child)]
+
+
+def pss(pid='self'):
+    # Proportional set size: shared pages are split between the processes mapping them, so that the sum over the
+    # main process and its workers is the memory they use together
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) * 1024
+
+
+def loader_memory():
+    total = pss()
+    for pid in children(os.getpid()):
+        try:
+            total += pss(pid)
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def throughput(loader, batches):
+    it = iter(loader)
+    next(it)
+    memory = 0
+    n = 0
+    start = time.time()
+    for i in range(batches):
+        try:
+            x, _ = next(it)
+        except StopIteration:
+            it = iter(loader)
+            x, _ = next(it)
+        n += x.size(0)
+        if i % 10 == 0:
+            memory = max(memory, loader_memory())
+    return n / (time.time() - start), memory
+
+
+def execute(args):
+    transform = transforms.Compose([
+        transforms.Resize((256, 256), interpolation=1),
+        transforms.ToTensor(),
+    ])
+    dataset = image_folder(args.root, transform, args.image_format)
+    base = pss()
+    loaders = (
+        (f'{args.workers} worker processes', data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                                            num_workers=args.workers, drop_last=True)),
+        (f'1 worker, {args.threads} threads', threaded_loader(dataset, args.batch_size, args.threads, shuffle=True,
+                                                             drop_last=True)),
+    )
+    mb = 1024 ** 2
+    for name, loader in loaders:
+        speed, memory = throughput(loader, args.batches)
+        print(f'{name}: {speed:.1f} images/sec, {(memory - base) / mb:.1f} MB over the main process alone (PSS)')
+        del loader
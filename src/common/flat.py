@@ -0,0 +1,87 @@
+"""Parameters of a network held in one contiguous buffer.
+
+`flatten` copies the parameters of a network into a flat buffer and makes them views of it, as well as their
+gradients. The EMA of the network is then a single `lerp_` and its Adam step updates a single tensor. The state dicts
+of the network are unchanged, and `FlatAdam` saves and loads the per-parameter layout of `torch.optim.Adam`, so that
+checkpoints load either way.
+
+`Module.to` replaces the parameters: the networks are flattened once on their device.
+"""
+import torch
+import torch.nn as nn
+
+
+class FlatParameters:
+    def __init__(self, parameters):
+        parameters = list(parameters)
+        self.shapes = [p.shape for p in parameters]
+        self.param = nn.Parameter(torch.cat([p.detach().reshape(-1) for p in parameters]))
+        self.param.grad = torch.zeros_like(self.param)
+        for p, data, grad in zip(parameters, self.split(self.param.data), self.split(self.param.grad)):
+            p.data = data
+            p.grad = grad
+
+    def split(self, flat):
+        # Views of a flat tensor with the shapes of the parameters
+        return [x.view(shape) for x, shape in zip(flat.split([s.numel() for s in self.shapes]), self.shapes)]
+
+
+def unwrap(module):
+    # The network of a DataParallel
+    return getattr(module, 'module', module)
+
+
+def flatten(module):
+    unwrap(module).flat_parameters = FlatParameters(module.parameters())
+    return module
+
+
+def flat_parameters(module):
+    """The flat buffer of a flattened network, or None."""
+    flat = getattr(unwrap(module), 'flat_parameters', None)
+    return None if flat is None else flat.param.data
+
+
+class FlatAdam(torch.optim.Adam):
+    def __init__(self, flat, **kwargs):
+        super().__init__([flat.param], **kwargs)
+        self.flat = flat
+
+    def zero_grad(self, set_to_none=False):
+        # The gradients of the parameters are views of the flat gradient, which is zeroed rather than released
+        self.flat.param.grad.zero_()
+
+    def state_dict(self):
+        state = super().state_dict()
+        indices = list(range(len(self.flat.shapes)))
+        flat = state['state'].get(0)
+        if flat is not None:
+            split = {k: self.flat.split(v) for k, v in flat.items() if torch.is_tensor(v) and v.dim() > 0}
+            state['state'] = {i: {k: split[k][i] if k in split else v for k, v in flat.items()} for i in indices}
+        state['param_groups'][0]['params'] = indices
+        return state
+
+    def load_state_dict(self, state_dict):
+        state = dict(state_dict)
+        params = state['param_groups'][0]['params']
+        if len(params) == len(self.flat.shapes) and state['state']:
+            # Concatenates the per-parameter state. Parameters without state (never stepped) start from zero
+            per_param = [state['state'].get(i) for i in params]
+            first = next(s for s in per_param if s is not None)
+            flat = {}
+            for k, v in first.items():
+                if torch.is_tensor(v) and v.dim() > 0:
+                    v = torch.cat([(s[k] if s is not None else torch.zeros(shape)).reshape(-1).to(v)
+                                   for s, shape in zip(per_param, self.flat.shapes)])
+                flat[k] = v
+            state['state'] = {params[0]: flat}
+        state['param_groups'] = [dict(state['param_groups'][0], params=params[:1])]
+        super().load_state_dict(state)
+
+
+def adam(module, **kwargs):
+    """FlatAdam for a flattened network, torch.optim.Adam otherwise."""
+    flat = getattr(unwrap(module), 'flat_parameters', None)
+    if flat is None:
+        return torch.optim.Adam(module.parameters(), **kwargs)
+    return FlatAdam(flat, **kwargs)
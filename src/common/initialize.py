@@ -2,6 +2,7 @@ import os
 from importlib import import_module
 import torch
 from common.util import get_args
+from common.loaders.resume import resumable
 
 
 def initialize(models, reload, dir, model_path):
@@ -13,6 +14,16 @@ def initialize(models, reload, dir, model_path):
     return models
 
 
+def resume_samplers(loaders, reload, dir, model_path):
+    """Samplers of the shuffled loaders, restored from the last checkpoint. Runs saved before the samplers were
+    checkpointed restart the data order.
+    """
+    samplers = {name: resumable(loader) for name, loader in loaders.items()}
+    samplers = {name: sampler for name, sampler in samplers.items() if sampler is not None}
+    saved = all(any(True for _ in filter_name(name, dir)) for name in samplers)
+    return initialize(samplers, reload and saved, dir, model_path)
+
+
 def infer_iteration(name, reload, model_path, save_path):
     resume = reload and has_models(model_path)
     if not resume:
@@ -0,0 +1,97 @@
+import math
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+from common.loaders.timing import stage
+
+
+def warp(x, theta, padding_mode='border', mode='bilinear'):
+    grid = F.affine_grid(theta, x.size(), align_corners=False)
+    return F.grid_sample(x, grid, mode=mode, padding_mode=padding_mode, align_corners=False)
+
+
+class BatchRandomResizedCrop:
+    """Batched equivalent of RandomResizedCrop applied with probability `crop_prob`, followed by a random
+    horizontal flip. Every sample gets its own crop, and the whole batch is resampled with one grid_sample.
+    """
+    def __init__(self, crop_prob=0.5, scale=(0.8, 1.0), ratio=(0.9, 1.1), flip_prob=0.5):
+        self.crop_prob = crop_prob
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.flip_prob = flip_prob
+
+    def __call__(self, x):
+        N = x.size(0)
+        scale = torch.empty(N).uniform_(*self.scale)
+        ratio = torch.empty(N).uniform_(*self.log_ratio).exp()
+        crop = torch.rand(N) < self.crop_prob
+        w = torch.where(crop, (scale * ratio).sqrt().clamp(max=1), torch.ones(N))
+        h = torch.where(crop, (scale / ratio).sqrt().clamp(max=1), torch.ones(N))
+        flip = torch.where(torch.rand(N) < self.flip_prob, -torch.ones(N), torch.ones(N))
+
+        theta = torch.zeros(N, 2, 3)
+        theta[:, 0, 0] = w * flip
+        theta[:, 0, 2] = (torch.rand(N) * 2 - 1) * (1 - w)
+        theta[:, 1, 1] = h
+        theta[:, 1, 2] = (torch.rand(N) * 2 - 1) * (1 - h)
+        return warp(x, theta.to(x.device))
+
+
+class BatchRandomAffine:
+    """Batched equivalent of RandomAffine(degrees, (0, 0), scale, shear) on square images.
+
+    The inverse of the rotation/scale/shear matrix is sampled for every sample and the batch is warped around the
+    image center with one grid_sample. Like RandomAffine, it uses nearest resampling and fills with zeros.
+    """
+    def __init__(self, degrees, scale, shear, mode='nearest'):
+        self.degrees = degrees
+        self.scale = scale
+        self.shear = shear
+        self.mode = mode
+
+    def __call__(self, x):
+        N = x.size(0)
+        rot = torch.empty(N).uniform_(-self.degrees, self.degrees) * math.pi / 180
+        shear = torch.empty(N).uniform_(-self.shear, self.shear) * math.pi / 180
+        scale = torch.empty(N).uniform_(*self.scale)
+        a = rot.cos()
+        b = -rot.cos() * shear.tan() - rot.sin()
+        c = rot.sin()
+        d = -rot.sin() * shear.tan() + rot.cos()
+
+        theta = torch.zeros(N, 2, 3)
+        theta[:, 0, 0] = d / scale
+        theta[:, 0, 1] = -b / scale
+        theta[:, 1, 0] = -c / scale
+        theta[:, 1, 1] = a / scale
+        return warp(x, theta.to(x.device), padding_mode='zeros', mode=self.mode)
+
+
+class MultiTransformBatch:
+    """Returns the batch along with its augmented copy, as MultiTransformDataset does per sample."""
+    def __init__(self, augment):
+        self.augment = augment
+
+    def __call__(self, batch):
+        x, y = batch
+        return x, self.augment(x), y
+
+
+class AugmentCollate:
+    """Collates a batch and applies a batched augmentation to the image fields.
+
+    Loaders whose dataset already returns whole batches pass `collate=list`.
+    """
+    def __init__(self, augment, fields=(0,), collate=default_collate):
+        self.augment = augment
+        self.fields = fields
+        self.collate = collate
+
+    def __call__(self, batch):
+        with stage('collate'):
+            batch = self.collate(batch)
+        with stage('transform'):
+            for field in self.fields:
+                batch[field] = self.augment(batch[field])
+        return batch
@@ -0,0 +1,19 @@
+from PIL import Image
+
+
+class DraftLoader:
+    """Loads images with PIL's draft mode: JPEGs are decoded straight from the DCT at the largest reduction
+    (1/2, 1/4 or 1/8) that keeps both sides at least `size`, before the resize of the transforms.
+    Other formats are fully decoded.
+    """
+    def __init__(self, size=256):
+        self.size = size
+
+    def __repr__(self):
+        return f'{type(self).__name__}(size={self.size})'
+
+    def __call__(self, path):
+        with open(path, 'rb') as f:
+            img = Image.open(f)
+            img.draft('RGB', (self.size, self.size))
+            return img.convert('RGB')
@@ -1,55 +1,160 @@
 import os
 import random
+from concurrent.futures import ThreadPoolExecutor
 import torch.utils.data as data
 import numpy as np
 import torch
 from torchvision import datasets, transforms
 from PIL import Image
 from torch.utils.data.sampler import SubsetRandomSampler
+from torch.utils.data.dataloader import default_collate
+from common.loaders.memmap import MemmapFolder
+from common.loaders.decode import DraftLoader
+from common.loaders.shards import ShardFolder, ShardStream, PairShardStream
+from common.loaders.integrity import SVHN
+from common.loaders.timing import stage, timed
+from common.loaders.resume import ResumableBatchSampler
+from common.loaders.augment import AugmentCollate, BatchRandomResizedCrop, BatchRandomAffine, MultiTransformBatch
+
+SPLITS = ('train', 'valid', 'test')
+
+
+class TensorImages(data.Dataset):
+    """uint8 images held in memory, returned as float tensors in [0, 1] (or [-1, 1] if normalize).
+
+    Indexing with a list of indices returns the whole batch at once, which is how `batch_loader` uses it.
+    """
+    def __init__(self, images, targets, normalize=False, root=None, split=None):
+        self.images = images
+        self.targets = torch.as_tensor(targets).long()
+        self.normalize = normalize
+        self.root = root
+        self.split = split
 
+    def __getitem__(self, index):
+        with stage('transform'):
+            x = self.images[index].float().div_(255)
+            if self.normalize:
+                x = x.sub_(0.5).div_(0.5)
+        return x, self.targets[index]
+
+    def __len__(self):
+        return len(self.images)
 
-def svhn(root, train_batch_size, test_batch_size, valid_split=0, **kwargs):
-    transform = transforms.Compose((
-        transforms.ToTensor(),))
-    train = datasets.SVHN(root, split='train', download=True, transform=transform)
-    n_classes = len(set(train.labels))
-    test = datasets.SVHN(root, split='test', download=True, transform=transform)
+    def __repr__(self):
+        # Part of the key of the label cache (see common.loaders.labels)
+        return f'{type(self).__name__}(size={tuple(self.images.shape[1:])}, normalize={self.normalize})'
 
-    idxes = np.arange(len(train))
-    split = int(np.floor(valid_split * len(idxes)))
-    train_sampler = SubsetRandomSampler(idxes[split:])
-    valid_sampler = SubsetRandomSampler(idxes[:split])
-    train_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size,
-                                               sampler=train_sampler, num_workers=8, drop_last=True)
-    valid_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size,
-                                               sampler=valid_sampler, num_workers=8)
-    test_loader = torch.utils.data.DataLoader(test, batch_size=test_batch_size, num_workers=8, shuffle=False)
 
-    shape = train_loader.dataset[0][0].shape
+def mnist_images(root, train, normalize=False):
+    dataset = datasets.MNIST(root, train=train, download=True)
+    # Same pixels as transforms.Resize(32, interpolation=0)
+    idx = ((torch.arange(32).double() + 0.5) * 28 / 32).long()
+    images = dataset.data[:, idx][:, :, idx]
+    images = images.unsqueeze(1).expand(-1, 3, -1, -1).contiguous()
+    return TensorImages(images, dataset.targets, normalize, root, 'train' if train else 'test')
+
+
+def svhn_images(root, split, normalize=False):
+    dataset = SVHN(root, split=split, download=True)
+    return TensorImages(torch.from_numpy(dataset.data), dataset.labels, normalize, root, split)
+
+
+def batch_sampler(dataset, batch_size, shuffle=False, drop_last=False, indices=None):
+    # Shuffled batches can be resumed from a checkpoint (see common.loaders.resume)
+    if shuffle:
+        indices = np.arange(len(dataset)) if indices is None else indices
+        return ResumableBatchSampler(indices, batch_size, drop_last)
+    return data.BatchSampler(data.SequentialSampler(dataset), batch_size, drop_last)
+
+
+def batch_loader(dataset, batch_size, sampler=None, shuffle=False, drop_last=False, collate_fn=None, indices=None):
+    if sampler is None:
+        batches = batch_sampler(dataset, batch_size, shuffle, drop_last, indices)
+    else:
+        batches = data.BatchSampler(sampler, batch_size, drop_last)
+    return data.DataLoader(dataset, batch_size=None, sampler=batches, collate_fn=collate_fn)
+
+
+_pools = {}
+
+
+def thread_pool(threads):
+    # One pool per process, as DataLoader workers are forked from the process that made the loader
+    key = (os.getpid(), threads)
+    if key not in _pools:
+        _pools[key] = ThreadPoolExecutor(threads)
+    return _pools[key]
+
+
+class ThreadedBatches(data.Dataset):
+    """Fetches the items of a list of indices with a thread pool and collates them. Single items are returned as is.
+
+    PIL decodes and resizes without the GIL, so a few threads in one worker replace the worker processes.
+    """
+    def __init__(self, dataset, threads):
+        self.dataset = dataset
+        self.threads = threads
+
+    def __getitem__(self, idxs):
+        if isinstance(idxs, int):
+            return self.dataset[idxs]
+        items = list(thread_pool(self.threads).map(self.dataset.__getitem__, idxs))
+        with stage('collate'):
+            return default_collate(items)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def threaded_loader(dataset, batch_size, threads, shuffle=False, drop_last=False, collate_fn=None, **kwargs):
+    batches = batch_sampler(dataset, batch_size, shuffle, drop_last)
+    return data.DataLoader(ThreadedBatches(dataset, threads), batch_size=None, sampler=batches,
+                           num_workers=1, collate_fn=collate_fn, **kwargs)
+
+
+def split_loaders(train, test, train_batch_size, test_batch_size, valid_split):
+    # Splits that were not built (None) get no loader
+    train_loader = valid_loader = test_loader = None
+    if train is not None:
+        idxes = np.arange(len(train))
+        split = int(np.floor(valid_split * len(idxes)))
+        valid_sampler = SubsetRandomSampler(idxes[:split])
+        train_loader = batch_loader(train, train_batch_size, shuffle=True, drop_last=True, indices=idxes[split:])
+        valid_loader = batch_loader(train, train_batch_size, valid_sampler)
+    if test is not None:
+        test_loader = batch_loader(test, test_batch_size)
+    return train_loader, valid_loader, test_loader
+
+
+def split_info(train, test):
+    dataset = train if train is not None else test
+    return dataset[0][0].shape, len(set(dataset.targets.tolist()))
+
+
+def svhn(root, train_batch_size, test_batch_size, valid_split=0, splits=SPLITS, **kwargs):
+    train = svhn_images(root, 'train') if {'train', 'valid'} & set(splits) else None
+    test = svhn_images(root, 'test') if 'test' in splits else None
+
+    train_loader, valid_loader, test_loader = split_loaders(train, test, train_batch_size, test_batch_size,
+                                                            valid_split)
+    shape, n_classes = split_info(train, test)
 
     return train_loader, valid_loader, test_loader, shape, n_classes
 
 
-def svhn_extra(root, train_batch_size, test_batch_size, valid_split=0, **kwargs):
-    transform = transforms.Compose((
-        transforms.ToTensor(),))
-    train = datasets.SVHN(root, split='train', download=True, transform=transform)
-    n_classes = len(set(train.labels))
-    extra = datasets.SVHN(root, split='extra', download=True, transform=transform)
-    train = torch.utils.data.ConcatDataset((train, extra))
-    test = datasets.SVHN(root, split='test', download=True, transform=transform)
-
-    idxes = np.arange(len(train))
-    split = int(np.floor(valid_split * len(idxes)))
-    train_sampler = SubsetRandomSampler(idxes[split:])
-    valid_sampler = SubsetRandomSampler(idxes[:split])
-    train_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size,
-                                               sampler=train_sampler, num_workers=8, drop_last=True)
-    valid_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size,
-                                               sampler=valid_sampler, num_workers=8)
-    test_loader = torch.utils.data.DataLoader(test, batch_size=test_batch_size, num_workers=8)
+def svhn_extra(root, train_batch_size, test_batch_size, valid_split=0, splits=SPLITS, **kwargs):
+    train = None
+    if {'train', 'valid'} & set(splits):
+        train = svhn_images(root, 'train')
+        extra = svhn_images(root, 'extra')
+        train = TensorImages(torch.cat((train.images, extra.images)), torch.cat((train.targets, extra.targets)),
+                             root=root, split='train+extra')
+    test = svhn_images(root, 'test') if 'test' in splits else None
 
-    shape = train_loader.dataset[0][0].shape
+    train_loader, valid_loader, test_loader = split_loaders(train, test, train_batch_size, test_batch_size,
+                                                            valid_split)
+    shape, n_classes = split_info(train, test)
 
     return train_loader, valid_loader, test_loader, shape, n_classes
 
@@ -60,32 +165,20 @@ def triple_channel(x):
     return torch.cat((x,x,x), 0)
 
 
-def mnist(root, train_batch_size, test_batch_size, valid_split=0, **kwargs):
-    transform = transforms.Compose([
-        transforms.Resize(32, interpolation=0),
-        transforms.ToTensor(),
-        triple_channel,
-        ])
-    train = datasets.MNIST(root, train=True, download=True, transform=transform)
-    test = datasets.MNIST(root, train=False, download=True, transform=transform)
+def mnist(root, train_batch_size, test_batch_size, valid_split=0, splits=SPLITS, **kwargs):
+    train = mnist_images(root, train=True) if {'train', 'valid'} & set(splits) else None
+    test = mnist_images(root, train=False) if 'test' in splits else None
 
-    idxes = np.arange(len(train))
-    split = int(np.floor(valid_split * len(idxes)))
-    train_sampler = SubsetRandomSampler(idxes[split:])
-    valid_sampler = SubsetRandomSampler(idxes[:split])
-    train_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size,
-                                               sampler=train_sampler, num_workers=8, drop_last=True)
-    valid_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size,
-                                               sampler=valid_sampler, num_workers=8)
-    test_loader = torch.utils.data.DataLoader(test, batch_size=test_batch_size, shuffle=False, num_workers=8)
-
-    shape = train_loader.dataset[0][0].shape
-    n_classes = len(set(train.train_labels.tolist()))
+    train_loader, valid_loader, test_loader = split_loaders(train, test, train_batch_size, test_batch_size,
+                                                            valid_split)
+    shape, n_classes = split_info(train, test)
 
     return train_loader, valid_loader, test_loader, shape, n_classes
 
 
-def imnist(root, train_batch_size, test_batch_size, valid_split, **kwargs):
+def imnist(root, train_batch_size, test_batch_size, valid_split, batch_augment=False, **kwargs):
+    if batch_augment:
+        return imnist_batch(root, train_batch_size, test_batch_size)
     transform = transforms.Compose([
         transforms.Resize(32, interpolation=0),
         transforms.ToTensor(),
@@ -97,8 +190,8 @@ def imnist(root, train_batch_size, test_batch_size, valid_split, **kwargs):
     train = MultiTransformDataset(train, t)
     test = datasets.MNIST(root, train=False, download=True, transform=transform)
 
-    train_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size,
-                                               shuffle=True, num_workers=8, drop_last=True)
+    train_loader = torch.utils.data.DataLoader(train, batch_sampler=batch_sampler(train, train_batch_size, True, True),
+                                               num_workers=8)
     test_loader = torch.utils.data.DataLoader(test, batch_size=test_batch_size or train_batch_size,
                                               shuffle=False, num_workers=8)
 
@@ -107,60 +200,98 @@ def imnist(root, train_batch_size, test_batch_size, valid_split, **kwargs):
     return train_loader, test_loader, test_loader, shape, n_classes
 
 
-@torch.no_grad()
-def cond_mnist_svhn(root, train_batch_size, test_batch_size, semantics, nc, device, **kwargs):
-    normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-    transform = transforms.Compose([
-        transforms.Resize(32, interpolation=0),
-        transforms.ToTensor(),
-        triple_channel,
-        normalize,
-    ])
+def imnist_batch(root, train_batch_size, test_batch_size):
+    train = mnist_images(root, train=True)
+    n_classes = len(set(train.targets.tolist()))
+    test = mnist_images(root, train=False)
+
+    augment = MultiTransformBatch(BatchRandomAffine(30, (0.5, 1.5), 40))
+    train_loader = batch_loader(train, train_batch_size, shuffle=True, drop_last=True, collate_fn=augment)
+    test_loader = batch_loader(test, test_batch_size or train_batch_size)
 
-    train1 = datasets.MNIST(root, train=True, download=True, transform=transform)
-    train2 = datasets.SVHN(root, split='train', download=True, transform=transform)
-    train = CondDataset(train1, train2, semantics, nc, device)
-    test1 = datasets.MNIST(root, train=False, download=True, transform=transform)
-    test2 = datasets.SVHN(root, split='test', download=True, transform=transform)
-    test = CondDataset(test1, test2, semantics, nc, device)
-
-    train_loader = data.DataLoader(train, batch_size=train_batch_size, shuffle=True,
-                                   num_workers=10, drop_last=True, pin_memory=False)
-    test_loader = data.DataLoader(test, batch_size=test_batch_size, shuffle=True,
-                                  num_workers=10, drop_last=False)
     shape = train_loader.dataset[0][0].shape
-    return train_loader, test_loader, shape, nc
 
+    return train_loader, test_loader, test_loader, shape, n_classes
 
-def mnist_svhn(root, train_batch_size, test_batch_size, **kwargs):
-    normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
-    transform = transforms.Compose([
-        transforms.Resize(32, interpolation=0),
-        transforms.ToTensor(),
-        triple_channel,
-        normalize,
-    ])
 
-    train1 = datasets.MNIST(root, train=True, download=True, transform=transform)
-    train2 = datasets.SVHN(root, split='train', download=True, transform=transform)
+@torch.no_grad()
+def cond_mnist_svhn(root, train_batch_size, test_batch_size, semantics, nc, device, label_batch_size=256,
+                    label_workers=8, label_store=None, pair_batches=False, **kwargs):
+    train1 = mnist_images(root, train=True, normalize=True)
+    train2 = svhn_images(root, 'train', normalize=True)
+    train = CondDataset(train1, train2, semantics, nc, device, label_batch_size, label_workers, label_store)
+    test1 = mnist_images(root, train=False, normalize=True)
+    test2 = svhn_images(root, 'test', normalize=True)
+    test = CondDataset(test1, test2, semantics, nc, device, label_batch_size, label_workers, label_store,
+                       lazy=True)
+
+    train_loader = cond_loader(train, train_batch_size, True, True, 10, pair_batches)
+    test_loader = cond_loader(test, test_batch_size, True, False, 10, pair_batches)
+    shape = train_loader.dataset[0][0].shape
+    return train_loader, test_loader, shape, nc
+
+
+def mnist_svhn(root, train_batch_size, test_batch_size, pair_batches=False, **kwargs):
+    train1 = mnist_images(root, train=True, normalize=True)
+    train2 = svhn_images(root, 'train', normalize=True)
     train = CondDataset(train1, train2)
-    test1 = datasets.MNIST(root, train=False, download=True, transform=transform)
-    test2 = datasets.SVHN(root, split='test', download=True, transform=transform)
-    test = CondDataset(test1, test2)
-
-    train_loader = data.DataLoader(train, batch_size=train_batch_size, shuffle=True,
-                                   num_workers=10, drop_last=True, pin_memory=False)
-    test_loader = data.DataLoader(test, batch_size=test_batch_size, shuffle=True,
-                                  num_workers=10, drop_last=False)
+    test1 = mnist_images(root, train=False, normalize=True)
+    test2 = svhn_images(root, 'test', normalize=True)
+    test = CondDataset(test1, test2, lazy=True)
+
+    train_loader = cond_loader(train, train_batch_size, True, True, 10, pair_batches)
+    test_loader = cond_loader(test, test_batch_size, True, False, 10, pair_batches)
     shape = train_loader.dataset[0][0].shape
     return train_loader, test_loader, shape, None
 
 
-def single_visda(root, train_batch_size, test_batch_size, shuffle=True, **kwargs):
+class ArrayImageFolder(data.Dataset):
+    """ImageFolder whose paths and targets are numpy arrays instead of lists of tuples.
+
+    Forked DataLoader workers otherwise copy the pages of the lists as they touch the refcounts of their items.
+    """
+    def __init__(self, root, transform=None, loader=None):
+        folder = datasets.ImageFolder(root)
+        self.root = root
+        self.transform = transform
+        self.loader = loader or folder.loader
+        self.classes = folder.classes
+        self.class_to_idx = folder.class_to_idx
+        self.paths = np.array([os.fsencode(path) for path, _ in folder.samples])
+        self.targets = np.array([target for _, target in folder.samples], dtype=np.int64)
+
+    @property
+    def samples(self):
+        return list(zip(map(os.fsdecode, self.paths), self.targets.tolist()))
+
+    def __getitem__(self, index):
+        with stage('decode'):
+            img = self.loader(os.fsdecode(self.paths[index]))
+        if self.transform is not None:
+            with stage('transform'):
+                img = self.transform(img)
+        return img, int(self.targets[index])
+
+    def __len__(self):
+        return len(self.paths)
+
+
+def image_folder(root, transform=None, image_format='folder'):
+    if image_format == 'memmap':
+        return MemmapFolder(root, transform)
+    if image_format == 'draft':
+        return ArrayImageFolder(root, transform, DraftLoader(256))
+    if image_format == 'shards':
+        return ShardFolder(root, transform)
+    return ArrayImageFolder(root, transform)
+
+
+def single_visda(root, train_batch_size, test_batch_size, shuffle=True, image_format='folder', batch_augment=False,
+                 randcrop_prob=0.5, decode_threads=0, shuffle_buffer=1000, **kwargs):
     crop = transforms.RandomResizedCrop(
         256, scale=[0.8, 1.0], ratio=[0.9, 1.1])
     rand_crop = transforms.Lambda(
-        lambda x: crop(x) if random.random() < 0.5 else x)
+        lambda x: crop(x) if random.random() < randcrop_prob else x)
     train_transform = [
         rand_crop,
         transforms.Resize((256, 256), interpolation=1),
@@ -174,24 +305,32 @@ def single_visda(root, train_batch_size, test_batch_size, shuffle=True, **kwargs
 
     train_transform = transforms.Compose(train_transform)
     test_transform = transforms.Compose(test_transform)
-    train = datasets.ImageFolder(root, train_transform)
-    test = datasets.ImageFolder(root, test_transform)
-
-    train_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size, pin_memory=False,
-                                               shuffle=shuffle, num_workers=10, drop_last=True)
-    test_loader = torch.utils.data.DataLoader(test, batch_size=test_batch_size, shuffle=shuffle,
-                                              num_workers=10, drop_last=False)
-
-    shape = train_loader.dataset[0][0].shape
+    batched = decode_threads and image_format != 'shards'
+    collate_fn = None
+    if batch_augment:
+        train_transform = test_transform
+        collate_fn = AugmentCollate(BatchRandomResizedCrop(randcrop_prob), fields=(0,),
+                                    collate=list if batched else default_collate)
+    train = image_folder(root, train_transform, image_format)
+    test = image_folder(root, test_transform, image_format)
+    if image_format == 'shards':
+        train = ShardStream([train], shuffle_buffer)
+
+    train_loader = cond_loader(train, train_batch_size, shuffle, True, 10, decode_threads=decode_threads,
+                               collate_fn=collate_fn)
+    test_loader = cond_loader(test, test_batch_size, shuffle, False, 10, decode_threads=decode_threads)
+
+    shape = test_loader.dataset[0][0].shape
     return train_loader, test_loader, shape, 5
 
 
-def visda(root, train_batch_size, test_batch_size, shuffle=True, **kwargs):
+def visda(root, train_batch_size, test_batch_size, shuffle=True, image_format='folder', batch_augment=False,
+          randcrop_prob=0.5, pair_batches=False, decode_threads=0, shuffle_buffer=1000, **kwargs):
     normalize = transforms.Normalize(mean=[0.5,0.5,0.5], std=[0.5,0.5,0.5])
     crop = transforms.RandomResizedCrop(
         256, scale=[0.8, 1.0], ratio=[0.9, 1.1])
     rand_crop = transforms.Lambda(
-        lambda x: crop(x) if random.random() < 0.5 else x)
+        lambda x: crop(x) if random.random() < randcrop_prob else x)
     train_transform = [
         rand_crop,
         transforms.Resize((256, 256), interpolation=1),
@@ -207,25 +346,34 @@ def visda(root, train_batch_size, test_batch_size, shuffle=True, **kwargs):
 
     train_transform = transforms.Compose(train_transform)
     test_transform = transforms.Compose(test_transform)
-    train = SourceDataset(os.path.join(root, 'train'), None, train_transform)
-    test = SourceDataset(os.path.join(root, 'test'), None, test_transform)
-
-    train_loader = torch.utils.data.DataLoader(train, batch_size=train_batch_size, pin_memory=False,
-                                               shuffle=shuffle, num_workers=10, drop_last=True)
-    test_loader = torch.utils.data.DataLoader(test, batch_size=test_batch_size, shuffle=shuffle,
-                                              num_workers=10, drop_last=False)
-
-    shape = train_loader.dataset[0][0].shape
+    # Loaders fetching whole batches (streamed shards are fetched per item)
+    batched = (pair_batches or decode_threads) and image_format != 'shards'
+    collate_fn = None
+    if batch_augment:
+        train_transform = test_transform
+        collate_fn = AugmentCollate(BatchRandomResizedCrop(randcrop_prob), fields=(0, 3, 4),
+                                    collate=list if batched else default_collate)
+    train = SourceDataset(os.path.join(root, 'train'), None, train_transform, image_format=image_format)
+    test = SourceDataset(os.path.join(root, 'test'), None, test_transform, image_format=image_format, lazy=True)
+    if image_format == 'shards':
+        train = PairShardStream(train, shuffle_buffer)
+
+    train_loader = cond_loader(train, train_batch_size, shuffle, True, 10, pair_batches, decode_threads, collate_fn)
+    test_loader = cond_loader(test, test_batch_size, shuffle, False, 10, pair_batches, decode_threads)
+
+    shape = test_loader.dataset[0][0].shape
     return train_loader, test_loader, shape, 1
 
 
 @torch.no_grad()
-def cond_visda(root, train_batch_size, test_batch_size, semantics, nc, device, **kwargs):
+def cond_visda(root, train_batch_size, test_batch_size, semantics, nc, device, label_batch_size=256,
+               label_workers=8, label_store=None, image_format='folder', batch_augment=False, randcrop_prob=0.5,
+               pair_batches=False, decode_threads=0, shuffle_buffer=1000, **kwargs):
     normalize = transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5])
     crop = transforms.RandomResizedCrop(
         256, scale=[0.8, 1.0], ratio=[0.9, 1.1])
     rand_crop = transforms.Lambda(
-        lambda x: crop(x) if random.random() < 0.5 else x)
+        lambda x: crop(x) if random.random() < randcrop_prob else x)
     train_transform = transforms.Compose([
         rand_crop,
         transforms.Resize((256, 256), interpolation=1),
@@ -238,15 +386,25 @@ def cond_visda(root, train_batch_size, test_batch_size, semantics, nc, device, *
         transforms.ToTensor(),
         normalize,
     ])
-
-    train = SourceDataset(os.path.join(root, 'train'), semantics, train_transform)
-    test = SourceDataset(os.path.join(root, 'test'), semantics, test_transform)
-
-    train_loader = data.DataLoader(train, batch_size=train_batch_size, shuffle=True,
-                                   num_workers=8, drop_last=True, pin_memory=True)
-    test_loader = data.DataLoader(test, batch_size=test_batch_size, shuffle=True,
-                                  num_workers=8, drop_last=False)
-    shape = train_loader.dataset[0][0].shape
+    # Loaders fetching whole batches (streamed shards are fetched per item)
+    batched = (pair_batches or decode_threads) and image_format != 'shards'
+    collate_fn = None
+    if batch_augment:
+        train_transform = test_transform
+        collate_fn = AugmentCollate(BatchRandomResizedCrop(randcrop_prob), fields=(0, 3, 4),
+                                    collate=list if batched else default_collate)
+
+    train = SourceDataset(os.path.join(root, 'train'), semantics, train_transform, device,
+                          label_batch_size, label_workers, label_store, image_format)
+    test = SourceDataset(os.path.join(root, 'test'), semantics, test_transform, device,
+                         label_batch_size, label_workers, label_store, image_format, lazy=True)
+    if image_format == 'shards':
+        train = PairShardStream(train, shuffle_buffer)
+
+    train_loader = cond_loader(train, train_batch_size, True, True, 8, pair_batches, decode_threads, collate_fn,
+                               pin_memory=True)
+    test_loader = cond_loader(test, test_batch_size, True, False, 8, pair_batches, decode_threads)
+    shape = test_loader.dataset[0][0].shape
     return train_loader, test_loader, shape, nc
 
 
@@ -273,7 +431,7 @@ class dataset_svhn(data.Dataset):
             transforms.ToTensor(),
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
         ])
-        self.dataset = datasets.SVHN(dataroot, split='test', download=True, transform=transform)
+        self.dataset = SVHN(dataroot, split='test', download=True, transform=transform)
 
     def __getitem__(self, index):
         return self.dataset[index][0]
@@ -283,26 +441,37 @@ class dataset_svhn(data.Dataset):
 
 
 class dataset_single(data.Dataset):
-    def __init__(self, dataroot):
+    def __init__(self, dataroot, image_format='folder'):
         self.dataroot = dataroot
-        images = os.listdir(self.dataroot)
-        self.img = [os.path.join(self.dataroot, x) for x in images]
-        self.img = list(sorted(self.img))
-        self.size = len(self.img)
-        self.input_dim = 3
-
         # setup image transformation
         transform = [transforms.Resize((256, 256), 1)]
         transform.append(transforms.ToTensor())
         transform.append(transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]))
         self.transforms = transforms.Compose(transform)
 
+        self.memmap = None
+        self.loader = DraftLoader(256) if image_format == 'draft' else None
+        if image_format == 'memmap':
+            self.memmap = MemmapFolder(dataroot, self.transforms)
+            self.img = self.memmap.files
+        else:
+            images = os.listdir(self.dataroot)
+            self.img = [os.path.join(self.dataroot, x) for x in images]
+            self.img = list(sorted(self.img))
+        self.size = len(self.img)
+        self.input_dim = 3
+
     def __getitem__(self, index):
+        if self.memmap is not None:
+            return self.memmap[index][0]
         data = self.load_img(self.img[index])
         return data
 
     def load_img(self, img_name):
-        img = Image.open(img_name).convert('RGB')
+        if self.loader is not None:
+            img = self.loader(img_name)
+        else:
+            img = Image.open(img_name).convert('RGB')
         img = self.transforms(img)
         return img
 
@@ -310,13 +479,182 @@ class dataset_single(data.Dataset):
         return len(self.img)
 
 
+@torch.no_grad()
+def infer_labels(dataset, semantics, device, batch_size=256, num_workers=8, store=None, rescale=True):
+    if store is not None:
+        cached = store.load(dataset, rescale)
+        if cached is not None:
+            return cached
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+    labels = []
+    targets = []
+    for batch in loader:
+        if isinstance(batch, (tuple, list)):
+            sample, target = batch
+        else:
+            sample, target = batch, torch.zeros(len(batch)).long()
+        sample = sample.to(device)
+        if rescale:
+            sample = (sample+1)*0.5
+        labels.append(semantics(sample).argmax(1).cpu())
+        targets.append(torch.as_tensor(target).long())
+    labels, targets = torch.cat(labels), torch.cat(targets)
+    if store is not None:
+        store.save(dataset, labels, targets, rescale)
+    return labels, targets
+
+
+class PairIndex:
+    """Samples indices sharing a label (and optionally a domain) in O(1).
+
+    Indices are sorted once by (label, domain) so that every bucket is a contiguous
+    slice of `order`, delimited by `bounds`.
+    """
+    def __init__(self, labels, domains):
+        labels = np.asarray(labels, dtype=np.int64)
+        domains = np.asarray(domains, dtype=np.int64)
+        self.n_domains = int(domains.max()) + 1
+        n_labels = int(labels.max()) + 1
+        keys = labels * self.n_domains + domains
+        self.order = np.argsort(keys, kind='stable')
+        self.bounds = np.searchsorted(keys[self.order], np.arange(n_labels * self.n_domains + 1))
+
+    def sample(self, label, domain=None):
+        label = int(label)
+        if domain is None:
+            start = self.bounds[label * self.n_domains]
+            end = self.bounds[(label + 1) * self.n_domains]
+        else:
+            bucket = label * self.n_domains + int(domain)
+            start, end = self.bounds[bucket], self.bounds[bucket + 1]
+        return int(self.order[random.randint(int(start), int(end) - 1)])
+
+    def sample_batch(self, labels, domains=None):
+        labels = np.asarray(labels, dtype=np.int64)
+        if domains is None:
+            start = self.bounds[labels * self.n_domains]
+            end = self.bounds[(labels + 1) * self.n_domains]
+        else:
+            bucket = labels * self.n_domains + np.asarray(domains, dtype=np.int64)
+            start, end = self.bounds[bucket], self.bounds[bucket + 1]
+        # torch RNG, as numpy is not reseeded in the DataLoader workers
+        offset = (torch.rand(len(labels)).double().numpy() * (end - start)).astype(np.int64)
+        return self.order[start + offset]
+
+
+class PairBatchSampler(data.Sampler):
+    """Yields the (3, B) anchor, partner and diversity indices of a batch, drawn in one vectorized step."""
+    def __init__(self, dataset, batch_size, shuffle=True, drop_last=False):
+        self.batches = batch_sampler(dataset, batch_size, shuffle, drop_last)
+        self.labels = np.asarray(dataset.labels, dtype=np.int64)
+        self.domains = np.asarray(dataset.domains, dtype=np.int64)
+        self.pairs = dataset.pairs
+
+    def __iter__(self):
+        for idx in self.batches:
+            idx = np.asarray(idx, dtype=np.int64)
+            with stage('pairs'):
+                labels = self.labels[idx]
+                idx2 = self.pairs.sample_batch(labels)
+                idx_ds = self.pairs.sample_batch(labels, self.domains[idx2])
+                idxs = np.stack((idx, idx2, idx_ds))
+            yield idxs
+
+    def __len__(self):
+        return len(self.batches)
+
+
+def tensor_parts(dataset):
+    # The TensorImages making up the dataset, or None if it holds other datasets
+    parts = dataset.datasets if isinstance(dataset, data.ConcatDataset) else [dataset]
+    return parts if all(isinstance(part, TensorImages) for part in parts) else None
+
+
+def load_images(dataset, idxs, threads=0):
+    parts = tensor_parts(dataset)
+    if parts is not None:
+        # In-memory images: every part is indexed with all its indices at once
+        idxs = np.asarray(idxs, dtype=np.int64)
+        bounds = np.cumsum([0] + [len(part) for part in parts])
+        which = np.searchsorted(bounds, idxs, side='right') - 1
+        images = None
+        for i, part in enumerate(parts):
+            mask = which == i
+            if mask.any():
+                x, _ = part[torch.from_numpy(idxs[mask] - bounds[i])]
+                if images is None:
+                    images = x.new_empty((len(idxs),) + x.shape[1:])
+                images[torch.from_numpy(mask)] = x
+        return images
+    idxs = idxs.tolist()
+    if threads:
+        images = [x for x, _ in thread_pool(threads).map(dataset.__getitem__, idxs)]
+    else:
+        images = [dataset[i][0] for i in idxs]
+    with stage('collate'):
+        return torch.stack(images)
+
+
+def load_pairs(dataset, labels, domains, idxs, lazy=False, threads=0):
+    """Assembles `x, y, d, x2, x_ds, d2` for the indices of a PairBatchSampler, loading every unique image once.
+    In lazy mode, x2 and x_ds are the indices of the partners (idx_src2 and idx_ds of the InputFetchers).
+    """
+    loaded = idxs[:1] if lazy else idxs
+    with stage('pairs'):
+        unique, inverse = np.unique(loaded, return_inverse=True)
+    samples = load_images(dataset, unique, threads)
+    with stage('collate'):
+        samples = samples[torch.from_numpy(inverse.reshape(loaded.shape))]
+    idx, idx2 = torch.from_numpy(idxs[0]), torch.from_numpy(idxs[1])
+    if lazy:
+        x, = samples
+        x2, x_ds = idx2, torch.from_numpy(idxs[2])
+    else:
+        x, x2, x_ds = samples
+    return x, labels[idx], domains[idx], x2, x_ds, domains[idx2]
+
+
+def pair_loader(dataset, batch_size, shuffle=True, drop_last=False, collate_fn=None, threads=0, **kwargs):
+    sampler = PairBatchSampler(dataset, batch_size, shuffle, drop_last)
+    dataset.threads = threads
+    if threads:
+        kwargs['num_workers'] = 1
+    return data.DataLoader(dataset, batch_size=None, sampler=sampler, collate_fn=collate_fn, **kwargs)
+
+
+def cond_loader(dataset, batch_size, shuffle, drop_last, num_workers, pair_batches=False, decode_threads=0,
+                collate_fn=None, pin_memory=False):
+    if isinstance(dataset, data.IterableDataset):
+        return data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, drop_last=drop_last,
+                               pin_memory=pin_memory, collate_fn=collate_fn or timed('collate', default_collate))
+    if pair_batches:
+        return pair_loader(dataset, batch_size, shuffle, drop_last, collate_fn, decode_threads,
+                           num_workers=num_workers, pin_memory=pin_memory)
+    if decode_threads:
+        return threaded_loader(dataset, batch_size, decode_threads, shuffle, drop_last, collate_fn,
+                               pin_memory=pin_memory)
+    return data.DataLoader(dataset, batch_sampler=batch_sampler(dataset, batch_size, shuffle, drop_last),
+                           num_workers=num_workers, pin_memory=pin_memory,
+                           collate_fn=collate_fn or timed('collate', default_collate))
+
+
 class SourceDataset(data.Dataset):
-    def __init__(self, root, semantic=None, transform=None):
+    """Domains are the subfolders of `root`. In lazy mode, only the anchor image is loaded and the partner and
+    diversity fields hold their indices, which can be loaded with `load`. The InputFetchers of the models pass them as
+    idx_src2 and idx_ds, never as images.
+    """
+    threads = 0
+
+    def __init__(self, root, semantic=None, transform=None, device='cuda', batch_size=256, num_workers=8,
+                 store=None, image_format='folder', lazy=False):
+        self.image_format = image_format
+        self.lazy = lazy
+        self.device = device
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.store = store
         self.datasets, self.targets, self.domains = self._make_dataset(root, transform, semantic)
-
-        d1 = os.listdir(root)[0]
-        n_labels = len(os.listdir(os.path.join(root, d1)))
-        self.labels_idxs = [torch.nonzero(self.targets == label)[:, 0] for label in range(n_labels)]
+        self.pairs = PairIndex(self.targets, self.domains)
 
     def _make_dataset(self, root, transform, semantic):
         domain_names = os.listdir(root)
@@ -326,88 +664,88 @@ class SourceDataset(data.Dataset):
         maps = [1, 0, 4, 2, 3]
         #maps = [2, 3, 0, 1, 4]
         for idx, domain in enumerate(sorted(domain_names)):
-            correct = 0
-            total = 0
             path = os.path.join(root, domain)
-            dataset = datasets.ImageFolder(path, transform)
+            dataset = image_folder(path, transform, self.image_format)
             if semantic:
-                for data, gt in dataset:
-                    data = data.cuda()
-                    data = (data.unsqueeze(0)+1)*0.5
-                    label = semantic(data).argmax(1)
-                    labels.append(label)
-                    correct += int(maps[gt] == label)
-                    total += 1
-                print(f'Accuracy for {domain}: {correct / total}')
+                label, gt = infer_labels(dataset, semantic, self.device, self.batch_size, self.num_workers,
+                                         self.store)
+                correct = (torch.LongTensor(maps)[gt] == label).sum().item()
+                print(f'Accuracy for {domain}: {correct / len(label)}')
+                labels.append(label)
             else:
-                labels += [0] * len(dataset)
+                labels.append(torch.zeros(len(dataset)).long())
             datas.append(dataset)
             domains += [idx] * len(dataset)
-        return torch.utils.data.ConcatDataset(datas), torch.LongTensor(labels), domains
+        return torch.utils.data.ConcatDataset(datas), torch.cat(labels), torch.LongTensor(domains)
+
+    @property
+    def labels(self):
+        return self.targets
 
     def __getitem__(self, index):
+        if isinstance(index, np.ndarray):
+            return load_pairs(self.datasets, self.targets, self.domains, index, self.lazy, self.threads)
         sample, _ = self.datasets[index]
         target = self.targets[index]
         domain = self.domains[index]
-        idxs = self.labels_idxs[target]
-        idx2 = idxs[random.randint(0, len(idxs)-1)]
+        with stage('pairs'):
+            idx2 = self.pairs.sample(target)
+            domain2 = self.domains[idx2]
+            idx_ds = self.pairs.sample(target, domain2)
+        if self.lazy:
+            return sample, target, domain, idx2, idx_ds, domain2
 
         sample2, target2 = self.datasets[idx2]
-        domain2 = self.domains[idx2]
-
-        idx_domain = torch.nonzero(torch.LongTensor(self.domains) == domain2, as_tuple=True)[0]
-        idxs_ds = list(set(idxs.tolist()) & set(idx_domain.tolist()))
-        idx_ds = idxs_ds[random.randint(0, len(idxs_ds)-1)]
         sample_ds, _ = self.datasets[idx_ds]
 
         return sample, target, domain, sample2, sample_ds, domain2
 
+    def load(self, idxs):
+        return load_images(self.datasets, idxs)
+
     def __len__(self):
         return len(self.datasets)
 
 
 class CondDataset(data.Dataset):
-    def __init__(self, dataset1, dataset2, semantics=None, nc=10, device='cuda'):
-        labels = []
-        self.domains = [0]*len(dataset1) + [1]*len(dataset2)
+    """Pairs of two datasets as domains 0 and 1. The lazy mode is the same as SourceDataset's."""
+    threads = 0
+
+    def __init__(self, dataset1, dataset2, semantics=None, nc=10, device='cuda', batch_size=256, num_workers=8,
+                 store=None, lazy=False):
+        self.lazy = lazy
+        self.domains = torch.LongTensor([0]*len(dataset1) + [1]*len(dataset2))
         self.dataset = data.ConcatDataset((dataset1, dataset2))
         if semantics:
-
             print('Infering semantics for dataset1')
-            for sample, _ in dataset1:
-                sample = sample.to(device)
-                sample = (sample.unsqueeze(0)+1)*0.5
-                label = semantics(sample).argmax(1)
-                labels.append(label)
+            labels1, _ = infer_labels(dataset1, semantics, device, batch_size, num_workers, store)
             print('Infering semantics for dataset2')
-            for sample, _ in dataset2:
-                sample = sample.to(device)
-                sample = (sample.unsqueeze(0)+1)*0.5
-                label = semantics(sample).argmax(1)
-                labels.append(label)
-
-            self.labels = torch.LongTensor(labels)
-            self.labels_idxs = [torch.nonzero(self.labels == label)[:, 0] for label in range(nc)]
+            labels2, _ = infer_labels(dataset2, semantics, device, batch_size, num_workers, store)
+            self.labels = torch.cat((labels1, labels2))
         else:
             self.labels = torch.LongTensor([0]*len(self.domains))
-            self.labels_idxs = [torch.arange(len(self.labels))]
+        self.pairs = PairIndex(self.labels, self.domains)
 
     def __getitem__(self, idx):
+        if isinstance(idx, np.ndarray):
+            return load_pairs(self.dataset, self.labels, self.domains, idx, self.lazy, self.threads)
         sample, _ = self.dataset[idx]
         target = self.labels[idx]
         domain = self.domains[idx]
-        idxs = self.labels_idxs[target]
-        idx2 = idxs[random.randint(0, len(idxs)-1)]
+        with stage('pairs'):
+            idx2 = self.pairs.sample(target)
+            domain2 = self.domains[idx2]
+            idx_ds = self.pairs.sample(target, domain2)
+        if self.lazy:
+            return sample, target, domain, idx2, idx_ds, domain2
 
         sample2, _ = self.dataset[idx2]
-        domain2 = self.domains[idx2]
-
-        idx_domain = torch.nonzero(torch.LongTensor(self.domains) == domain2, as_tuple=True)[0]
-        idxs_ds = list(set(idxs.tolist()) & set(idx_domain.tolist()))
-        idx_ds = idxs_ds[random.randint(0, len(idxs_ds)-1)]
         sample_ds, _ = self.dataset[idx_ds]
         return sample, target, domain, sample2, sample_ds, domain2
 
+    def load(self, idxs):
+        return load_images(self.dataset, idxs)
+
     def __len__(self):
         return len(self.dataset)
 
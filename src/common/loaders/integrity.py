@@ -0,0 +1,40 @@
+import os
+from torchvision import datasets
+from torchvision.datasets.utils import check_integrity
+
+
+def stamp(fpath, md5):
+    st = os.stat(fpath)
+    return f'{md5} {st.st_size} {st.st_mtime_ns}'
+
+
+def verified(fpath, md5):
+    """check_integrity, skipping the MD5 when `<fpath>.verified` records that the file was verified with the same size
+    and mtime.
+    """
+    if not os.path.isfile(fpath):
+        return False
+    stamp_path = f'{fpath}.verified'
+    if os.path.exists(stamp_path):
+        with open(stamp_path) as f:
+            if f.read() == stamp(fpath, md5):
+                return True
+    if not check_integrity(fpath, md5):
+        return False
+    try:
+        with open(stamp_path, 'w') as f:
+            f.write(stamp(fpath, md5))
+    except OSError:
+        pass
+    return True
+
+
+class SVHN(datasets.SVHN):
+    """SVHN whose archive is only hashed again when its size or mtime changes."""
+    def _check_integrity(self):
+        return verified(os.path.join(self.root, self.split_list[self.split][1]), self.split_list[self.split][2])
+
+    def download(self):
+        if self._check_integrity():
+            return
+        super().download()
@@ -0,0 +1,77 @@
+import hashlib
+import os
+import re
+import numpy as np
+import torch
+from torch.utils import data
+
+from common.initialize import get_last_model
+
+
+def checkpoint_fingerprint(path):
+    if not path:
+        return ''
+    return f'{os.path.realpath(path)}:{os.path.getmtime(path)}'
+
+
+def preprocessing(dataset):
+    # The inferred labels depend on what the semantics network sees: the format of the images (folder, draft, memmap,
+    # in memory), their size, transform and normalization. The repr of the dataset, its loader and its transform
+    # describe it, without the addresses of the functions
+    parts = [repr(dataset)] + [f'{name}={getattr(dataset, name)!r}' for name in ('loader', 'transform', 'transforms')
+                               if getattr(dataset, name, None) is not None]
+    return re.sub(r' at 0x[0-9a-f]+', '', '\n'.join(parts))
+
+
+def dataset_files(dataset):
+    if isinstance(dataset, data.ConcatDataset):
+        return [f for d in dataset.datasets for f in dataset_files(d)]
+    if hasattr(dataset, 'samples'):
+        return [path for path, _ in dataset.samples] + [preprocessing(dataset)]
+    if hasattr(dataset, 'img'):
+        return list(dataset.img) + [preprocessing(getattr(dataset, 'memmap', None) or dataset)]
+    if hasattr(dataset, 'dataset'):
+        return dataset_files(dataset.dataset)
+    split = getattr(dataset, 'split', getattr(dataset, 'train', None))
+    return [type(dataset).__name__, os.path.realpath(dataset.root), str(split), str(len(dataset)),
+            preprocessing(dataset)]
+
+
+class LabelStore:
+    """On-disk cache of the labels inferred by a semantics model.
+
+    Labels are saved as `<root>/<key>.npy`, where the key hashes the cluster checkpoint, the self-supervised
+    checkpoint (None for the models without one), the rescale of the inputs, and the files (or, for in-memory
+    datasets, the kind and split) and preprocessing of the dataset. `root` defaults to the `labels` folder of the
+    cluster run. Changes of the preprocessing code that keep its description (e.g. another resampling of MNIST to
+    32x32) need the cache to be cleared.
+    """
+    def __init__(self, cluster_path, ss_path, root=None):
+        self.root = root or os.path.join(cluster_path, 'labels')
+        cluster = get_last_model('classifier', cluster_path)
+        self.models = [checkpoint_fingerprint(cluster), checkpoint_fingerprint(ss_path)]
+
+    def key(self, dataset, rescale=True):
+        h = hashlib.sha1()
+        for line in self.models + [f'rescale={rescale}'] + dataset_files(dataset):
+            h.update(line.encode())
+            h.update(b'\n')
+        return h.hexdigest()
+
+    def path(self, dataset, rescale=True):
+        return os.path.join(self.root, f'{self.key(dataset, rescale)}.npy')
+
+    def load(self, dataset, rescale=True):
+        path = self.path(dataset, rescale)
+        if not os.path.exists(path):
+            return None
+        labels, targets = torch.from_numpy(np.load(path))
+        return labels, targets
+
+    def save(self, dataset, labels, targets, rescale=True):
+        os.makedirs(self.root, exist_ok=True)
+        path = self.path(dataset, rescale)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, np.stack((labels.numpy(), targets.numpy())))
+        os.replace(tmp, path)
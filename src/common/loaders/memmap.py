@@ -0,0 +1,116 @@
+"""Pre-decoded image folders backed by memory-mapped uint8 arrays.
+
+A folder converted with `convert` holds `images.npy`, an N x size x size x 3 uint8 array, and `index.npz` with the
+targets, class names and source files of the images. Directory trees (e.g. `data/train/<domain>/<class>`) are
+mirrored, so that every ImageFolder (or flat folder of images) is converted to a folder of the same relative path.
+
+Usage:
+    python -m common.loaders.memmap data/ data_memmap/ --size 256 --workers 8
+"""
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+import numpy as np
+import torch.utils.data as data
+from PIL import Image
+from torchvision.datasets.folder import IMG_EXTENSIONS
+
+from common.loaders.timing import stage
+
+
+class MemmapFolder(data.Dataset):
+    def __init__(self, root, transform=None):
+        self.root = root
+        self.transform = transform
+        index = np.load(os.path.join(root, 'index.npz'))
+        self.targets = index['targets']
+        self.classes = index['classes'].tolist()
+        self.files = index['files']
+        self.images = np.load(os.path.join(root, 'images.npy'), mmap_mode='r')
+
+    @property
+    def samples(self):
+        return list(zip(self.files.tolist(), self.targets.tolist()))
+
+    def __getitem__(self, index):
+        with stage('decode'):
+            img = Image.fromarray(self.images[index])
+        if self.transform is not None:
+            with stage('transform'):
+                img = self.transform(img)
+        return img, int(self.targets[index])
+
+    def __len__(self):
+        return len(self.images)
+
+    def __repr__(self):
+        # Part of the key of the label cache (see common.loaders.labels)
+        return f'{type(self).__name__}(images={self.images.shape})'
+
+
+def is_image(path):
+    return path.lower().endswith(IMG_EXTENSIONS)
+
+
+def list_images(root):
+    return sorted(os.path.join(root, f) for f in os.listdir(root) if is_image(f))
+
+
+def list_folder(root):
+    files = list_images(root)
+    if files:
+        return files, [0] * len(files), []
+    classes = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root, d)))
+    files = []
+    targets = []
+    for target, c in enumerate(classes):
+        images = list_images(os.path.join(root, c))
+        files += images
+        targets += [target] * len(images)
+    return files, targets, classes
+
+
+def load_resized(args):
+    path, size = args
+    img = Image.open(path).convert('RGB')
+    return np.asarray(img.resize((size, size), 1))
+
+
+def convert_folder(src, dst, size=256, workers=8):
+    files, targets, classes = list_folder(src)
+    os.makedirs(dst, exist_ok=True)
+    images = np.lib.format.open_memmap(os.path.join(dst, 'images.npy'), mode='w+',
+                                       dtype=np.uint8, shape=(len(files), size, size, 3))
+    with Pool(workers) as pool:
+        for i, img in enumerate(pool.imap(load_resized, [(f, size) for f in files], chunksize=64)):
+            images[i] = img
+    images.flush()
+    np.savez(os.path.join(dst, 'index.npz'), targets=np.array(targets, dtype=np.int64),
+             classes=np.array(classes), files=np.array(files))
+    print(f'Converted {src}: {len(files)} images')
+
+
+def is_folder(root):
+    if list_images(root):
+        return True
+    subdirs = [os.path.join(root, d) for d in os.listdir(root)]
+    return any(list_images(d) for d in subdirs if os.path.isdir(d))
+
+
+def convert(src, dst, size=256, workers=8):
+    if is_folder(src):
+        convert_folder(src, dst, size, workers)
+        return
+    for d in sorted(os.listdir(src)):
+        if os.path.isdir(os.path.join(src, d)):
+            convert(os.path.join(src, d), os.path.join(dst, d), size, workers)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('src', type=str, help='Root of the image folders to convert')
+    parser.add_argument('dst', type=str, help='Root of the converted folders')
+    parser.add_argument('--size', type=int, default=256, help='Size of the stored images')
+    parser.add_argument('--workers', type=int, default=8, help='Number of decoding processes')
+    args = parser.parse_args()
+    convert(args.src, args.dst, args.size, args.workers)
@@ -0,0 +1,77 @@
+import queue
+import threading
+import time
+import torch
+
+
+class Prefetcher:
+    """Prepares the next `size` inputs of a fetcher in a background thread, while the training step runs.
+
+    On CUDA, the inputs are copied on a side stream that the training stream waits on. With `size=0`, the inputs are
+    fetched synchronously. In both cases, `wait_time` accumulates the time the training loop spent waiting for data.
+    """
+    def __init__(self, fetcher, size=2):
+        self.fetcher = fetcher
+        self.size = size
+        self.wait_time = 0.
+        if size == 0:
+            return
+        device = getattr(fetcher, 'device', 'cpu')
+        self.stream = torch.cuda.Stream() if torch.device(device).type == 'cuda' else None
+        self.queue = queue.Queue(size)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _produce(self):
+        while not self.stop.is_set():
+            try:
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        inputs = next(self.fetcher)
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+                else:
+                    inputs, event = next(self.fetcher), None
+                item = (inputs, event, None)
+            except Exception as e:
+                item = (None, None, e)
+            while not self.stop.is_set():
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if item[2] is not None:
+                return
+
+    def __next__(self):
+        start = time.time()
+        if self.size == 0:
+            inputs = next(self.fetcher)
+            self.wait_time += time.time() - start
+            return inputs
+        inputs, event, error = self.queue.get()
+        self.wait_time += time.time() - start
+        if error is not None:
+            raise error
+        if event is not None:
+            current = torch.cuda.current_stream()
+            current.wait_event(event)
+            for v in inputs.values():
+                v.record_stream(current)
+        return inputs
+
+    def __iter__(self):
+        return self
+
+    def close(self):
+        if self.size == 0 or not self.thread.is_alive():
+            return
+        self.stop.set()
+        while self.thread.is_alive():
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.1)
@@ -0,0 +1,64 @@
+"""Data order that is saved with the checkpoints.
+
+The shuffled loaders draw their batches from a `ResumableBatchSampler`: the permutation of every epoch is given by the
+seed of the sampler and the epoch, and the training loops count the batches they consume with `advance`. The state of
+the sampler (seed and batches consumed) is saved alongside the models, so that a reloaded run draws the same
+permutation and starts at the batch following the checkpoint, without replaying the epoch.
+
+The count is kept by the consumer rather than by the sampler, since the DataLoader workers (and the Prefetcher) fetch
+batches ahead of the training loop.
+"""
+import numpy as np
+import torch
+import torch.utils.data as data
+
+
+class ResumableBatchSampler(data.Sampler):
+    def __init__(self, indices, batch_size, drop_last=False, seed=None):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        # Drawn from the global RNG, so that --seed fixes the order
+        self.seed = int(torch.randint(2**31 - 1, ())) if seed is None else seed
+        self.batches = 0
+        self.epoch = 0
+        self.start = 0
+
+    def permutation(self, epoch):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + epoch)
+        return self.indices[torch.randperm(len(self.indices), generator=generator).numpy()]
+
+    def __iter__(self):
+        # A generator, so that the epoch starts with its first batch: the DataLoader may create the iterator twice
+        order, start = self.permutation(self.epoch), self.start
+        self.epoch, self.start = self.epoch + 1, 0
+        for b in range(start, len(self)):
+            yield order[b * self.batch_size:(b + 1) * self.batch_size].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def state_dict(self):
+        return {'seed': self.seed, 'batches': self.batches}
+
+    def load_state_dict(self, state):
+        self.seed, self.batches = state['seed'], state['batches']
+        self.epoch, self.start = divmod(self.batches, len(self))
+
+
+def resumable(loader):
+    """The ResumableBatchSampler of a loader, or None (e.g. unshuffled loaders and streamed shards)."""
+    sampler = loader.batch_sampler if loader.batch_sampler is not None else loader.sampler
+    while sampler is not None and not isinstance(sampler, ResumableBatchSampler):
+        sampler = getattr(sampler, 'batches', None)
+    return sampler
+
+
+def advance(loader, batches=1):
+    """Counts batches consumed by the training loop."""
+    sampler = resumable(loader)
+    if sampler is not None:
+        sampler.batches += batches
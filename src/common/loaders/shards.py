@@ -0,0 +1,197 @@
+"""Image folders stored as tar shards that are read sequentially.
+
+A folder converted with `convert` holds `shard-00000.tar`, `shard-00001.tar`, ... and `manifest.npz`. The manifest has,
+for every image, its source file, target, shard and the offset and size of its bytes in the shard, along with the
+class names and the domain (name of the converted folder). Images are shuffled once when sharding, so that every
+shard mixes the classes. Directory trees are mirrored as in `common.loaders.memmap`.
+
+Training streams whole shards in a random order through a shuffle buffer (`ShardStream`, `PairShardStream`), while
+`ShardFolder` gives random access for the test sets and the inference of the labels.
+
+Usage:
+    python -m common.loaders.shards data/ data_shards/ --shard-size 1000
+"""
+import io
+import os
+import random
+import tarfile
+from argparse import ArgumentParser
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+
+from common.loaders.memmap import list_folder, is_folder
+from common.loaders.timing import stage
+
+
+class ShardFolder(data.Dataset):
+    def __init__(self, root, transform=None):
+        self.root = root
+        self.transform = transform
+        manifest = np.load(os.path.join(root, 'manifest.npz'))
+        self.files = manifest['files']
+        self.targets = manifest['targets']
+        self.shards = manifest['shards']
+        self.offsets = manifest['offsets']
+        self.sizes = manifest['sizes']
+        self.classes = manifest['classes'].tolist()
+        self.domain = str(manifest['domain'])
+        self.n_shards = int(self.shards[-1]) + 1 if len(self.shards) else 0
+        self.bounds = np.searchsorted(self.shards, np.arange(self.n_shards + 1))
+
+    @property
+    def samples(self):
+        return list(zip(self.files.tolist(), self.targets.tolist()))
+
+    def shard_path(self, shard):
+        return os.path.join(self.root, f'shard-{shard:05d}.tar')
+
+    def decode(self, raw):
+        with stage('decode'):
+            img = Image.open(io.BytesIO(raw)).convert('RGB')
+        if self.transform is not None:
+            with stage('transform'):
+                img = self.transform(img)
+        return img
+
+    def read_shard(self, shard):
+        """Reads a shard in one sequential read and returns the indices of its images along with their bytes."""
+        with open(self.shard_path(shard), 'rb') as f:
+            content = f.read()
+        idxs = range(self.bounds[shard], self.bounds[shard + 1])
+        return [(i, content[self.offsets[i]:self.offsets[i] + self.sizes[i]]) for i in idxs]
+
+    def __getitem__(self, index):
+        with open(self.shard_path(self.shards[index]), 'rb') as f:
+            f.seek(int(self.offsets[index]))
+            raw = f.read(int(self.sizes[index]))
+        return self.decode(raw), int(self.targets[index])
+
+    def __len__(self):
+        return len(self.files)
+
+
+class ShardStream(data.IterableDataset):
+    """Streams the images of ShardFolders as (image, target), reading their shards in a random order and shuffling the
+    images through a buffer of `buffer_size` images. The shards are split among the DataLoader workers.
+    """
+    def __init__(self, folders, buffer_size=1000):
+        self.folders = folders
+        self.buffer_size = buffer_size
+        self.starts = np.cumsum([0] + [len(folder) for folder in folders])
+
+    def shard_order(self):
+        shards = [(f, shard) for f, folder in enumerate(self.folders) for shard in range(folder.n_shards)]
+        info = data.get_worker_info()
+        if info is None:
+            return [shards[i] for i in torch.randperm(len(shards)).tolist()]
+        # The workers are seeded with the base seed of the epoch plus their id: they all draw the same order
+        generator = torch.Generator()
+        generator.manual_seed(info.seed - info.id)
+        order = torch.randperm(len(shards), generator=generator).tolist()
+        return [shards[i] for i in order[info.id::info.num_workers]]
+
+    def records(self):
+        for f, shard in self.shard_order():
+            for idx, raw in self.folders[f].read_shard(shard):
+                yield f, self.starts[f] + idx, raw
+
+    def __iter__(self):
+        folders = np.empty(self.buffer_size, dtype=np.int64)
+        idxs = np.empty(self.buffer_size, dtype=np.int64)
+        raws = [None] * self.buffer_size
+        n = 0
+        for f, idx, raw in self.records():
+            folders[n], idxs[n], raws[n] = f, idx, raw
+            n += 1
+            if n == self.buffer_size:
+                yield self.pop(folders, idxs, raws, n)
+                n -= 1
+        while n:
+            yield self.pop(folders, idxs, raws, n)
+            n -= 1
+
+    def pop(self, folders, idxs, raws, n):
+        # Returns the item of a random slot and moves the last record of the buffer into that slot
+        i = random.randrange(n)
+        item = self.item(folders, idxs, raws, n, i)
+        folders[i], idxs[i], raws[i] = folders[n-1], idxs[n-1], raws[n-1]
+        raws[n-1] = None
+        return item
+
+    def decode(self, folders, idxs, raws, i):
+        return self.folders[folders[i]].decode(raws[i])
+
+    def item(self, folders, idxs, raws, n, i):
+        f = folders[i]
+        return self.decode(folders, idxs, raws, i), int(self.folders[f].targets[idxs[i] - self.starts[f]])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+
+class PairShardStream(ShardStream):
+    """Streams the items of a SourceDataset over ShardFolders: `x, y, d, x2, x_ds, d2`.
+
+    The partner (same label) and diversity (same label, domain of the partner) images are drawn from the shuffle
+    buffer rather than from the whole dataset.
+    """
+    def __init__(self, dataset, buffer_size=1000):
+        super().__init__(dataset.datasets.datasets, buffer_size)
+        self.labels = np.asarray(dataset.labels, dtype=np.int64)
+        self.domains = np.asarray(dataset.domains, dtype=np.int64)
+
+    def item(self, folders, idxs, raws, n, i):
+        with stage('pairs'):
+            labels = self.labels[idxs[:n]]
+            domains = self.domains[idxs[:n]]
+            label = labels[i]
+            partners = np.flatnonzero(labels == label)
+            j = partners[random.randrange(len(partners))]
+            diversity = partners[domains[partners] == domains[j]]
+            k = diversity[random.randrange(len(diversity))]
+        return (self.decode(folders, idxs, raws, i), int(label), int(domains[i]),
+                self.decode(folders, idxs, raws, j), self.decode(folders, idxs, raws, k), int(domains[j]))
+
+
+def convert_folder(src, dst, shard_size=1000):
+    files, targets, classes = list_folder(src)
+    order = np.random.RandomState(0).permutation(len(files))
+    files = [files[i] for i in order]
+    targets = np.array(targets, dtype=np.int64)[order]
+    os.makedirs(dst, exist_ok=True)
+    shards, offsets, sizes = [], [], []
+    for shard, start in enumerate(range(0, len(files), shard_size)):
+        path = os.path.join(dst, f'shard-{shard:05d}.tar')
+        with tarfile.open(path, 'w') as tar:
+            for i in range(start, min(start + shard_size, len(files))):
+                tar.add(files[i], arcname=f'{i:08d}{os.path.splitext(files[i])[1]}')
+        with tarfile.open(path) as tar:
+            for member in tar.getmembers():
+                shards.append(shard)
+                offsets.append(member.offset_data)
+                sizes.append(member.size)
+    np.savez(os.path.join(dst, 'manifest.npz'), files=np.array(files), targets=targets,
+             shards=np.array(shards, dtype=np.int64), offsets=np.array(offsets, dtype=np.int64),
+             sizes=np.array(sizes, dtype=np.int64), classes=np.array(classes),
+             domain=np.array(os.path.basename(os.path.normpath(src))))
+    print(f'Converted {src}: {len(files)} images in {len(range(0, len(files), shard_size))} shards')
+
+
+def convert(src, dst, shard_size=1000):
+    if is_folder(src):
+        convert_folder(src, dst, shard_size)
+        return
+    for d in sorted(os.listdir(src)):
+        if os.path.isdir(os.path.join(src, d)):
+            convert(os.path.join(src, d), os.path.join(dst, d), shard_size)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('src', type=str, help='Root of the image folders to convert')
+    parser.add_argument('dst', type=str, help='Root of the sharded folders')
+    parser.add_argument('--shard-size', type=int, default=1000, help='Number of images per shard')
+    args = parser.parse_args()
+    convert(args.src, args.dst, args.shard_size)
@@ -0,0 +1,108 @@
+"""Opt-in timings of the stages of the data pipeline, aggregated across the DataLoader workers.
+
+`enable()` is called before the loaders are built. The datasets then time their stages with `stage(name)`: the totals
+are accumulated in shared memory with one row per process, so that the forked workers write where the training loop
+reads them with `summary()`. When timing is not enabled, `stage` does nothing.
+
+Stages:
+    decode: reading and decoding an image
+    transform: per-image transforms and batched augmentations
+    pairs: sampling the partner and diversity images
+    collate: assembling the batches
+    wait: time InputFetcher waits on the DataLoader
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing import RawArray
+import numpy as np
+import torch.utils.data as data
+
+STAGES = ('decode', 'transform', 'pairs', 'collate', 'wait')
+
+_totals = None
+_last = None
+_locks = {}
+
+
+def enable(workers=16):
+    global _totals, _last
+    # Row 0 is the main process, workers share the other rows by id
+    _totals = np.frombuffer(RawArray('d', (workers + 1) * len(STAGES) * 2)).reshape(workers + 1, len(STAGES), 2)
+    _last = np.zeros((len(STAGES), 2))
+
+
+def enabled():
+    return _totals is not None
+
+
+def _lock():
+    # One lock per process, as the decoding threads of a worker share its row
+    pid = os.getpid()
+    lock = _locks.get(pid)
+    if lock is None:
+        lock = _locks.setdefault(pid, threading.Lock())
+    return lock
+
+
+def record(name, seconds):
+    if _totals is None:
+        return
+    info = data.get_worker_info()
+    row = 0 if info is None else 1 + info.id % (len(_totals) - 1)
+    with _lock():
+        _totals[row, STAGES.index(name)] += (seconds, 1)
+
+
+@contextmanager
+def stage(name):
+    if _totals is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - start)
+
+
+class Timed:
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+
+    def __call__(self, *args):
+        with stage(self.name):
+            return self.fn(*args)
+
+
+def timed(name, fn):
+    return Timed(name, fn) if _totals is not None else fn
+
+
+def reset():
+    if _totals is None:
+        return
+    _totals[:] = 0
+    _last[:] = 0
+
+
+def summary():
+    """Seconds spent in every stage since the last summary, summed over the processes, and milliseconds per call."""
+    totals = _totals.sum(0)
+    delta = totals - _last
+    _last[:] = totals
+    return {name: (delta[i, 0], 1000 * delta[i, 0] / max(delta[i, 1], 1)) for i, name in enumerate(STAGES)}
+
+
+def report(visualiser, step):
+    """Plots the summary of the stages and returns it formatted for the training log ('' if timing is disabled)."""
+    if _totals is None:
+        return ''
+    stages = summary()
+    for name, (seconds, ms) in stages.items():
+        visualiser.plot(seconds, title=f'Data {name} (s)', step=step)
+        visualiser.plot(ms, title=f'Data {name} (ms per call)', step=step)
+    return 'Stages [%s], ' % ', '.join('%s %.1fs %.2fms' % (name, seconds, ms)
+                                       for name, (seconds, ms) in stages.items())
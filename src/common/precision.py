@@ -0,0 +1,14 @@
+import contextlib
+import torch
+
+
+def autocast(enabled, device):
+    """Context of the bfloat16 mode: the forward passes and the losses run under autocast, while the parameters,
+    their gradients, the optimizer states and the EMA copies stay in fp32. bfloat16 has the exponent range of fp32, so
+    the losses (and the gradients of the R1 penalty) are not scaled.
+    """
+    if not enabled:
+        return contextlib.nullcontext()
+    if not hasattr(torch, 'autocast'):
+        raise RuntimeError('bfloat16 autocast requires torch >= 1.10')
+    return torch.autocast(torch.device(device).type, dtype=torch.bfloat16)
@@ -4,6 +4,7 @@ import numpy as np
 import torch
 import torchvision.utils as vutils
 import math
+from common.loaders.resume import advance
 
 
 def set_paths(args):
@@ -82,8 +83,10 @@ def sample(iterator, loader, expected_size=None):
     try:
         batch = next(iterator)
         if expected_size and batch.shape[0] != expected_size:
+            advance(loader)
             batch = next(iterator)
-        return batch, iterator
     except StopIteration:
         iterator = iter(loader)
-        return next(iterator), iterator
+        batch = next(iterator)
+    advance(loader)
+    return batch, iterator
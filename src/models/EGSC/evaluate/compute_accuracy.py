@@ -82,9 +82,9 @@ def execute(args):
     vgg = vgg19(pretrained=True).features[:feature_blocks].to(device)
 
     dataset = getattr(images, args.dataset_src)
-    src_dataset = dataset(data_root_src, 1, 32)[2]
+    src_dataset = dataset(data_root_src, 1, 32, splits=('test',))[2]
     dataset = getattr(images, args.dataset_trg)
-    trg_dataset = dataset(data_root_tgt, 1, 32)[2].dataset
+    trg_dataset = dataset(data_root_tgt, 1, 32, splits=('test',))[2].dataset
 
     accuracy = evaluate(src_dataset, trg_dataset, domain, style_encoder, vgg, generator, classifier, device)
     print(accuracy)
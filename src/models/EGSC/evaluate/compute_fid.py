@@ -25,6 +25,7 @@ def parse_args(parser):
 def execute(args):
     device = 'cuda'
     batch_size = 128
+    n_styles = 10
     # Load model
 
     state_dict = torch.load(args.state_dict_path, map_location='cpu')
@@ -38,7 +39,7 @@ def execute(args):
 
     dataset = getattr(images, args.dataset_src)
     src_dataset = dataset(args.data_root_src)
-    src = torch.utils.data.DataLoader(src_dataset, batch_size=batch_size, num_workers=10)
+    src = torch.utils.data.DataLoader(src_dataset, batch_size=batch_size // n_styles, num_workers=10)
     dataset = getattr(images, args.dataset_trg)
     trg_dataset = dataset(args.data_root_tgt)
     dataset = getattr(images, args.dataset_real)
@@ -51,14 +52,14 @@ def execute(args):
     d = torch.tensor(args.domain).repeat(batch_size).long().to(device)
     for data in src:
         data = data.to(device)
-        d_trg = d[:data.shape[0]]
         features = vgg((data+1)*0.5) # TODO align data
-        for i in range(10):
-            x_idxs = torch.randint(low=0, high=len(trg_dataset), size=(len(data),))
-            x_trg = torch.stack([trg_dataset[idx].to(device) for idx in x_idxs])
-            s_trg = style_encoder(x_trg, d_trg)
-            gen = generator(data, features, s_trg)
-            generated.append(gen)
+        # Encoded once and decoded with all its styles in one pass of about batch_size images
+        h = generator.content(data, features)
+        x_idxs = torch.randint(low=0, high=len(trg_dataset), size=(n_styles * len(data),))
+        x_trg = torch.stack([trg_dataset[idx].to(device) for idx in x_idxs])
+        s_trg = style_encoder(x_trg, d[:len(x_trg)])
+        gen = generator.stylize(h, s_trg)
+        generated.append(gen)
     generated = torch.cat(generated)
     generated = normalize(generated)
     print(generated.shape)
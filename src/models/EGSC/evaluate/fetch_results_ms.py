@@ -48,9 +48,9 @@ def execute(args):
     vgg = vgg19(pretrained=True).features[:feature_blocks].to(device)
 
     dataset = getattr(images, args.dataset_src)
-    src_dataset = dataset(data_root_src, 1, 1)[2].dataset
+    src_dataset = dataset(data_root_src, 1, 1, splits=('test',))[2].dataset
     dataset = getattr(images, args.dataset_trg)
-    trg_dataset = dataset(data_root_tgt, 1, 1)[2].dataset
+    trg_dataset = dataset(data_root_tgt, 1, 1, splits=('test',))[2].dataset
 
     data = []
     for i in range(N):
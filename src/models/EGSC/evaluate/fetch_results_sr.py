@@ -68,15 +68,16 @@ def execute(args):
     x_trg = [x_trg[0::5], x_trg[1::5], x_trg[2::5], x_trg[3::5], x_trg[4::5]]
     x_trg = torch.cat(x_trg)
     save_image(x_trg, 5, f'style_imgs:25.png')
+    features = vgg((data+1)*0.5) # TODO align data
+    h = generator.content(data, features)
     data = torch.cat(5*[data])
     save_image(data, 5, f'data:25.png')
 
     N, C, H, W = data.size()
     x_concat = [data]
 
-    features = vgg((data+1)*0.5) # TODO align data
     s_trg = style_encoder(x_trg, d_trg)
-    x_fake = generator(data, features, s_trg)
+    x_fake = generator.stylize(h, s_trg)
     x_concat += [x_fake]
 
     x_concat = torch.cat(x_concat, dim=0)
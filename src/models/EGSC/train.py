@@ -15,6 +15,11 @@ import torchvision.utils as vutils
 from torchvision.models import vgg19
 
 from .model import build_model
+from common.loaders import timing
+from common.precision import autocast
+from common.flat import flatten, flat_parameters, adam
+from common.loaders.prefetch import Prefetcher
+from common.loaders.resume import resumable, advance
 
 
 class Solver(nn.Module):
@@ -31,19 +36,6 @@ class Solver(nn.Module):
         for name, module in self.nets_ema.items():
             setattr(self, name + '_ema', module)
 
-        self.optims = Munch()
-        for net in self.nets.keys():
-            self.optims[net] = torch.optim.Adam(
-                params=self.nets[net].parameters(),
-                lr=args.f_lr if net == 'mapping_network' else args.lr,
-                betas=[args.beta1, args.beta2],
-                weight_decay=args.weight_decay)
-
-        self.ckptios = [
-            CheckpointIO(ospj(args.model_path, 'nets:{:06d}.ckpt'), **self.nets),
-            CheckpointIO(ospj(args.model_path, 'nets_ema:{:06d}.ckpt'), **self.nets_ema),
-            CheckpointIO(ospj(args.model_path, 'optims:{:06d}.ckpt'), **self.optims)]
-
         for name, network in self.named_children():
             # Do not initialize the EMA parameters
             if ('ema' not in name):
@@ -55,8 +47,29 @@ class Solver(nn.Module):
         self.vgg.eval()
         self.vgg = self.vgg.to(self.device)
 
+        # bfloat16 forward passes and losses with fp32 weights
+        self.autocast = autocast(args.bf16, args.device)
+
         self.to(self.device)
 
+        # The networks with an EMA are held in flat buffers, for one EMA update and one Adam step per network
+        for name in self.nets_ema.keys():
+            flatten(self.nets[name])
+            flatten(self.nets_ema[name])
+
+        self.optims = Munch()
+        for net in self.nets.keys():
+            self.optims[net] = adam(
+                self.nets[net],
+                lr=args.f_lr if net == 'mapping_network' else args.lr,
+                betas=[args.beta1, args.beta2],
+                weight_decay=args.weight_decay)
+
+        self.ckptios = [
+            CheckpointIO(ospj(args.model_path, 'nets:{:06d}.ckpt'), **self.nets),
+            CheckpointIO(ospj(args.model_path, 'nets_ema:{:06d}.ckpt'), **self.nets_ema),
+            CheckpointIO(ospj(args.model_path, 'optims:{:06d}.ckpt'), **self.optims)]
+
     def _save_checkpoint(self, step, checkpoint):
         for ckptio in self.ckptios:
             ckptio.save(step, checkpoint)
@@ -65,6 +78,17 @@ class Solver(nn.Module):
         for ckptio in self.ckptios:
             ckptio.load(step)
 
+    def _resume_sampler(self, loader, step):
+        # The order of the training batches is saved with the checkpoints (see common.loaders.resume)
+        sampler = resumable(loader)
+        if sampler is None:
+            return
+        ckptio = CheckpointIO(ospj(self.args.model_path, 'sampler:{:06d}.ckpt'), src=sampler)
+        # Checkpoints saved without the sampler restart the data order
+        if step > 0 and os.path.exists(ckptio.fname_template.format(step)):
+            ckptio.load(step)
+        self.ckptios.append(ckptio)
+
     def _reset_grad(self):
         for optim in self.optims.values():
             optim.zero_grad()
@@ -75,22 +99,26 @@ class Solver(nn.Module):
         nets_ema = self.nets_ema
         optims = self.optims
 
-        # fetch random validation images for debugging
-        fetcher = InputFetcher(loaders.src, args.latent_dim, args.device)
-        fetcher_val = InputFetcher(loaders.val, args.latent_dim, args.device)
-        inputs_val = next(fetcher_val)
-
         # resume training if necessary
         resume_iter = args.resume_iter
-        if args.resume_iter > 0:
+        if resume_iter > 0:
             self._load_checkpoint(resume_iter)
+        self._resume_sampler(loaders.src, resume_iter)
+
+        timing.reset()  # Discards the timings of the dataset setup
+        # fetch random validation images for debugging
+        fetcher = Prefetcher(InputFetcher(loaders.src, args.latent_dim, args.device), args.prefetch)
+        fetcher_val = InputFetcher(loaders.val, args.latent_dim, args.device)
+        inputs_val = next(fetcher_val)
 
         # remember the initial value of ds weight
         print('Start training...')
         start_time = time.time()
+        log_time, log_iter = start_time, resume_iter
         for i in range(resume_iter, args.total_iters):
             # fetch images and labels
             inputs = next(fetcher)
+            advance(loaders.src)
             x_real, d_org = inputs.x_src, inputs.d_src
             x_trg, d_trg = inputs.x_src2, inputs.d_src2
 
@@ -98,28 +126,39 @@ class Solver(nn.Module):
                 features_real = self.vgg((x_real + 1) / 2)
 
             # train the discriminator
-            d_loss, d_losses_ref = compute_d_loss(
-                nets, args, x_real, features_real, d_org, d_trg, x_trg=x_trg)
+            with self.autocast:
+                d_loss, d_losses_ref = compute_d_loss(
+                    nets, args, x_real, features_real, d_org, d_trg, x_trg=x_trg,
+                    reg=i % args.r1_every == 0)
             self._reset_grad()
             d_loss.backward()
             optims.discriminator.step()
 
-            g_loss, g_losses_ref = compute_g_loss(
-                nets, self.vgg, args, x_real, features_real, d_org, d_trg, x_ref=x_trg)
+            with self.autocast:
+                g_loss, g_losses_ref = compute_g_loss(
+                    nets, self.vgg, args, x_real, features_real, d_org, d_trg, x_ref=x_trg)
             self._reset_grad()
             g_loss.backward()
             optims.generator.step()
             optims.style_encoder.step()
 
-            # compute moving average of network parameters
-            moving_average(nets.generator, nets_ema.generator, beta=0.999)
-            moving_average(nets.style_encoder, nets_ema.style_encoder, beta=0.999)
+            # compute moving average of network parameters, with the decay of ema_every iterations
+            if (i+1) % args.ema_every == 0:
+                beta = 0.999 ** args.ema_every
+                moving_average(nets.generator, nets_ema.generator, beta=beta)
+                moving_average(nets.style_encoder, nets_ema.style_encoder, beta=beta)
 
             # print out log info
             if (i+1) % args.print_every == 0:
-                elapsed = time.time() - start_time
+                now = time.time()
+                throughput = (i+1 - log_iter) / (now - log_time)
+                log_time, log_iter = now, i+1
+                args.visualiser.plot(throughput, title='Throughput (it/s)', step=i+1)
+                elapsed = now - start_time
                 elapsed = str(datetime.timedelta(seconds=elapsed))[:-7]
-                log = "Elapsed time [%s], Iteration [%i/%i], " % (elapsed, i+1, args.total_iters)
+                log = "Elapsed time [%s], Data wait [%.1fs], Throughput [%.2f it/s], Iteration [%i/%i], " % (
+                    elapsed, fetcher.wait_time, throughput, i+1, args.total_iters)
+                log += timing.report(args.visualiser, i+1)
                 all_losses = dict()
                 for loss, prefix in zip([d_losses_ref, g_losses_ref],
                                         ['D/ref_', 'G/ref_']):
@@ -136,14 +175,15 @@ class Solver(nn.Module):
             # save model checkpoints
             if (i+1) % args.save_every == 0:
                 self._save_checkpoint(step=i+1, checkpoint=args.checkpoint)
+        fetcher.close()
 
 
-def compute_d_loss(nets, args, x_real, features_real, d_org, d_trg, x_trg):
-    # with real images
-    x_real.requires_grad_()
+def compute_d_loss(nets, args, x_real, features_real, d_org, d_trg, x_trg, reg=True):
+    # with real images, R1 only on the regularized D steps (lazy regularization, see --r1_every)
+    x_real = x_real.detach().requires_grad_(reg)
     out = nets.discriminator(x_real, d_org)
     loss_real = adv_loss(out, 1)
-    loss_reg = r1_reg(out, x_real)
+    loss_reg = r1_reg(out, x_real) if reg else torch.zeros_like(loss_real)
 
     # with fake images
     with torch.no_grad():
@@ -152,7 +192,7 @@ def compute_d_loss(nets, args, x_real, features_real, d_org, d_trg, x_trg):
     out = nets.discriminator(x_fake, d_trg)
     loss_fake = adv_loss(out, 0)
 
-    loss = loss_real + loss_fake + args.lambda_reg * loss_reg
+    loss = loss_real + loss_fake + args.lambda_reg * args.r1_every * loss_reg
     return loss, Munch(real=loss_real.item(),
                        fake=loss_fake.item(),
                        reg=loss_reg.item())
@@ -206,8 +246,12 @@ def gram_matrix(inputs):
 
 
 def moving_average(model, model_test, beta=0.999):
+    flat, flat_test = flat_parameters(model), flat_parameters(model_test)
+    if flat is not None and flat_test is not None:
+        flat_test.lerp_(flat, 1 - beta)
+        return
     for param, param_test in zip(model.parameters(), model_test.parameters()):
-        param_test.data = torch.lerp(param.data, param_test.data, beta)
+        param_test.data.lerp_(param.data, 1 - beta)
 
 
 def adv_loss(logits, target):
@@ -251,7 +295,6 @@ def he_init(module):
 @torch.no_grad()
 def debug_image(nets, args, inputs, step):
     x_src, d_src, y_src = inputs.x_src,  inputs.d_src, inputs.y_src
-    x_ref, d_ref        = inputs.x_src2, inputs.d_src2
 
     device = inputs.x_src.device
     N = inputs.x_src.size(0)
@@ -325,11 +368,12 @@ class InputFetcher:
         self.device = device
 
     def _fetch_inputs(self):
-        try:
-            x, _, d, x2, _, d2 = next(self.iter)
-        except (AttributeError, StopIteration):
-            self.iter = iter(self.loader)
-            x, _, d, x2, _, d2 = next(self.iter)
+        with timing.stage('wait'):
+            try:
+                x, _, d, x2, _, d2 = next(self.iter)
+            except (AttributeError, StopIteration):
+                self.iter = iter(self.loader)
+                x, _, d, x2, _, d2 = next(self.iter)
         return x, d, x2, d2
 
     def __next__(self):
@@ -337,5 +381,8 @@ class InputFetcher:
         inputs = Munch(x_src=x, x_src2=x2,
                        d_src2=d2, d_src=d)
 
+        if x2.dim() == 1:
+            # Lazy loaders (validation) only load the anchors: the partners are given by their indices
+            inputs.idx_src2 = inputs.pop('x_src2')
         return Munch({k: v.to(self.device)
                       for k, v in inputs.items()})
@@ -4,7 +4,7 @@ import torch.nn.functional as F
 import matplotlib.pyplot as plt
 from torch import optim
 from common.util import save_models, sample, normalize_channels
-from common.initialize import initialize, infer_iteration
+from common.initialize import initialize, infer_iteration, resume_samplers
 from . import model
 
 
@@ -52,6 +52,7 @@ def train(args):
                                  nesterov=args.nesterov, weight_decay=args.weight_decay)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optim_classifier, args.iterations)
 
+    samplers = resume_samplers({'sampler': train_loader}, args.reload, args.save_path, args.model_path)
     it = iter(train_loader)
     iteration = infer_iteration(list(models.keys())[0], args.reload, args.model_path, args.save_path)
     t0 = time.time()
@@ -78,4 +79,5 @@ def train(args):
             if valid_accuracy > best_accuracy:
                 best_accuracy = valid_accuracy
                 save_models(models, i, args.model_path, args.checkpoint)
+                save_models(samplers, i, args.model_path, args.checkpoint)
             t0 = time.time()
@@ -11,13 +11,15 @@ def parse_args(parser):
     parser.add_argument('--beta2', type=float, default=0.99, help='Adam parameter')
     parser.add_argument('--d-updates', type=int, default=4, help='N critic updates per generator update')
     parser.add_argument('--ld', type=float, default=1, help='Lambda distance loss')
+    parser.add_argument('--batch-augment', action='store_true', help='Apply the random affine augmentation on the whole batch')
 
 
 def execute(args):
     print(args)
     dataset = getattr(images, args.dataset)
     train_loader, _, test_loader, shape, n_classes = dataset(
-        args.dataset_loc, args.train_batch_size, args.test_batch_size, args.valid_split)
+        args.dataset_loc, args.train_batch_size, args.test_batch_size, args.valid_split,
+        batch_augment=args.batch_augment)
     args.loaders = (train_loader, test_loader)
     args.shape = shape
 
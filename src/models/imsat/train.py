@@ -6,7 +6,7 @@ from sklearn.decomposition import PCA
 import matplotlib.pylab as plt
 
 from common.util import sample, save_models, one_hot_embedding
-from common.initialize import initialize, infer_iteration
+from common.initialize import initialize, infer_iteration, resume_samplers
 from . import model
 
 
@@ -114,6 +114,7 @@ def train(args):
     optim_encoder = optim.Adam(encoder.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
     optim_contrastive = optim.Adam(contrastive.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
 
+    samplers = resume_samplers({'sampler1': train_loader1}, args.reload, args.save_path, args.model_path)
     iter1 = iter(train_loader1)
     iteration = infer_iteration(list(models.keys())[0], args.reload, args.model_path, args.save_path)
     mone = torch.FloatTensor([-1]).to(args.device)
@@ -155,3 +156,4 @@ def train(args):
 
             t0 = time.time()
             save_models(models, i, args.model_path, args.checkpoint)
+            save_models(samplers, i, args.model_path, args.checkpoint)
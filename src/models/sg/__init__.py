@@ -6,7 +6,7 @@ import os
 from munch import Munch
 
 from .train import Solver
-from common.loaders import images
+from common.loaders import images, timing
 from . import model
 
 
@@ -20,10 +20,18 @@ def execute(args):
 
     solver = Solver(args)
 
+    if args.profile_data:
+        timing.enable()
     dataset = getattr(images, args.dataset)
     src, val, _, _ = dataset(root=args.dataset_loc,
                              train_batch_size=args.train_batch_size,
                              test_batch_size=args.test_batch_size,
+                             image_format=args.image_format,
+                             batch_augment=args.batch_augment,
+                             pair_batches=args.pair_batches,
+                             decode_threads=args.decode_threads,
+                             shuffle_buffer=args.shuffle_buffer,
+                             randcrop_prob=args.randcrop_prob,
                              device=args.device)
     loaders = Munch(src=src,
                     ref=None,
@@ -46,12 +54,15 @@ def parse_args(parser):
 
     # weight for objective functions
     parser.add_argument('--lambda_reg', type=float, default=1, help='Weight for R1 regularization')
+    parser.add_argument('--r1_every', type=int, default=1, help='D steps between the R1 regularizations, weighted by r1_every (lazy regularization)')
     parser.add_argument('--lambda_cyc', type=float, default=1, help='Weight for cyclic consistency loss')
     parser.add_argument('--lambda_sty', type=float, default=1, help='Weight for style reconstruction loss')
     parser.add_argument('--lambda_ds', type=float, default=2, help='Weight for diversity sensitivity loss')
 
     # training arguments
     parser.add_argument('--randcrop_prob', type=float, default=0.5, help='Probabilty of using random-resized cropping')
+    parser.add_argument('--batch_augment', action='store_true', help='Apply the random crops and flips on the collated batch')
+    parser.add_argument('--pair_batches', action='store_true', help='Sample the pairs of a whole batch at once and load every image once')
     parser.add_argument('--total_iters', type=int, default=50000, help='Number of total iterations')
     parser.add_argument('--resume_iter', type=int, default=0, help='Iterations to resume training/testing')
     parser.add_argument('--lr', type=float, default=1e-4, help='Learning rate for D, E and G')
@@ -59,13 +70,20 @@ def parse_args(parser):
     parser.add_argument('--beta1', type=float, default=0.0, help='Decay rate for 1st moment of Adam')
     parser.add_argument('--beta2', type=float, default=0.99, help='Decay rate for 2nd moment of Adam')
     parser.add_argument('--weight_decay', type=float, default=1e-4, help='Weight decay for optimizer')
+    parser.add_argument('--bf16', action='store_true', help='Compute the losses under bfloat16 autocast, with fp32 weights (torch >= 1.10)')
+    parser.add_argument('--ema_every', type=int, default=1, help='Iterations between the updates of the EMA networks (decay 0.999 per iteration)')
     parser.add_argument('--num_outs_per_domain', type=int, default=10, help='Number of generated images per domain during sampling')
 
     parser.add_argument('--num_workers', type=int, default=4, help='Number of workers used in DataLoader')
+    parser.add_argument('--decode_threads', type=int, default=0, help='Decode the batches with a pool of threads in a single worker process (0: one process per worker)')
+    parser.add_argument('--prefetch', type=int, default=2, help='Number of input batches prepared in a background thread (0: fetched synchronously)')
+    parser.add_argument('--profile_data', action='store_true', help='Time the stages of the data pipeline (decode, transform, pairs, collate, wait) and report them every print_every iterations')
 
     # directory for training
     parser.add_argument('--dataset', type=str, default='visda', help='Which dataset to use [visda, mnist_svhn]')
     parser.add_argument('--dataset_loc', type=str, default='./data', help='Directory containing datasets')
+    parser.add_argument('--image_format', type=str, default='folder', choices=['folder', 'memmap', 'draft', 'shards'], help='Storage of the image datasets (draft: folders decoded with JPEG draft mode, shards: tar shards streamed sequentially)')
+    parser.add_argument('--shuffle_buffer', type=int, default=1000, help='Number of images in the shuffle buffer of each worker streaming the shards')
 
     # step size
     parser.add_argument('--print_every', type=int, default=1000)
@@ -73,7 +73,7 @@ def execute(args):
     classifier.eval()
 
     dataset = getattr(images, args.dataset_src)
-    src_dataset = dataset(data_root_src, 1, 64)[2]
+    src_dataset = dataset(data_root_src, 1, 64, splits=('test',))[2]
 
     accuracy = evaluate(src_dataset, nz, domain, mapping, generator, classifier, device)
     print(accuracy)
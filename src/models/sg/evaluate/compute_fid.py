@@ -24,6 +24,7 @@ def execute(args):
     device = 'cuda'
     latent_dim = 16
     batch_size = 128
+    n_styles = 10
     # Load model
     state_dict = torch.load(args.state_dict_path, map_location='cpu')
 
@@ -36,7 +37,7 @@ def execute(args):
     generator.eval()
 
     dataset = getattr(images, args.dataset_src)(args.data_root_src)
-    src = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=10)
+    src = torch.utils.data.DataLoader(dataset, batch_size=batch_size // n_styles, num_workers=10)
     dataset = getattr(images, args.dataset_tgt)(args.data_root_tgt)
     trg = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=10)
 
@@ -46,12 +47,12 @@ def execute(args):
     d = torch.tensor(args.domain).repeat(batch_size).long().to(device)
     for data in src:
         data = data.to(device)
-        d_trg = d[:data.shape[0]]
-        for i in range(10):
-            z_trg = torch.randn(data.shape[0], latent_dim, device=device)
-            s_trg = mapping(z_trg, d_trg)
-            gen = generator(data, s_trg)
-            generated.append(gen)
+        # Encoded once and decoded with all its styles in one pass of about batch_size images
+        h = generator.content(data)
+        z_trg = torch.randn(n_styles * data.shape[0], latent_dim, device=device)
+        s_trg = mapping(z_trg, d[:z_trg.shape[0]])
+        gen = generator.stylize(h, s_trg)
+        generated.append(gen)
     generated = torch.cat(generated)
     generated = normalize(generated)
 
@@ -64,7 +64,9 @@ class AdaIN(nn.Module):
         self.fc = nn.Linear(style_dim, num_features*2)
 
     def forward(self, x, s):
-        h = self.fc(s)
+        return self.modulate(x, self.fc(s))
+
+    def modulate(self, x, h):
         h = h.view(h.size(0), h.size(1), 1, 1)
         gamma, beta = torch.chunk(h, chunks=2, dim=1)
         return (1 + gamma) * self.norm(x) + beta
@@ -94,19 +96,22 @@ class AdainResBlk(nn.Module):
             x = self.conv1x1(x)
         return x
 
-    def _residual(self, x, s):
-        x = self.norm1(x, s)
+    def _residual(self, x, h1, h2):
+        x = self.norm1.modulate(x, h1)
         x = self.actv(x)
         if self.upsample:
             x = F.interpolate(x, scale_factor=2, mode='nearest')
         x = self.conv1(x)
-        x = self.norm2(x, s)
+        x = self.norm2.modulate(x, h2)
         x = self.actv(x)
         x = self.conv2(x)
         return x
 
     def forward(self, x, s):
-        out = self._residual(x, s)
+        return self.forward_projected(x, self.norm1.fc(s), self.norm2.fc(s))
+
+    def forward_projected(self, x, h1, h2):
+        out = self._residual(x, h1, h2)
         out = (out + self._shortcut(x)) / math.sqrt(2)
         return out
 
@@ -142,12 +147,33 @@ class Generator(nn.Module):
                 0, AdainResBlk(dim_out, dim_out, style_dim))
 
     def forward(self, x, s):
+        return self.stylize(self.content(x), s)
+
+    def content(self, x):
         x = self.from_rgb(x)
         for block in self.encode:
             x = block(x)
+        return x
+
+    def stylize(self, h, s):
+        # s stacks k styles per content, style after style: the k*N images are decoded in a single pass
+        return self.stylize_projected(h, self.project(s))
+
+    def project(self, s):
+        # Modulation of all the AdaIN layers of the decoder in one matmul. Can be cached for fixed styles
+        fcs = [norm.fc for block in self.decode for norm in (block.norm1, block.norm2)]
+        weight = torch.cat([fc.weight for fc in fcs])
+        bias = torch.cat([fc.bias for fc in fcs])
+        return F.linear(s, weight, bias).split([fc.out_features for fc in fcs], dim=1)
+
+    def stylize_projected(self, h, m):
+        # Each content is repeated for the k styles stacked in m, style after style
+        if m[0].size(0) > h.size(0):
+            h = h.repeat(m[0].size(0) // h.size(0), 1, 1, 1)
+        m = iter(m)
         for block in self.decode:
-            x = block(x, s)
-        return self.to_rgb(x)
+            h = block.forward_projected(h, next(m), next(m))
+        return self.to_rgb(h)
 
 
 def one_hot_embedding(labels, num_classes):
@@ -155,6 +181,14 @@ def one_hot_embedding(labels, num_classes):
     return y[labels]
 
 
+def select_heads(heads, h, idx):
+    # Runs every sample through its own head only, with one call per head present in the batch
+    order = torch.argsort(idx)
+    selected, counts = torch.unique_consecutive(idx[order], return_counts=True)
+    out = [heads[i](x) for i, x in zip(selected.tolist(), h[order].split(counts.tolist()))]
+    return torch.cat(out)[torch.argsort(order)]
+
+
 class MappingNetwork(nn.Module):
     def __init__(self, latent_dim=16, style_dim=64, num_domains=2):
         super().__init__()
@@ -178,13 +212,7 @@ class MappingNetwork(nn.Module):
 
     def forward(self, z, d):
         h = self.shared(z)
-        out = []
-        for layer in self.unshared:
-            out += [layer(h)]
-        out = torch.stack(out, dim=1)  # (batch, num_domains, style_dim)
-        idx = torch.LongTensor(range(d.size(0))).to(d.device)
-        s = out[idx, d]  # (batch, style_dim)
-        return s
+        return select_heads(self.unshared, h, d)
 
 
 class StyleEncoder(nn.Module):
@@ -218,14 +246,7 @@ class StyleEncoder(nn.Module):
     def forward(self, x, d):
         h = self.shared(x)
         h = h.view(h.size(0), -1)
-        out = []
-        for layer in self.unshared:
-            out += [layer(h)]
-        out = torch.stack(out, dim=1)  # (batch, num_domains, style_dim)
-        pos = d
-        idx = torch.LongTensor(range(d.size(0))).to(d.device)
-        s = out[idx, pos]  # (batch, style_dim)
-        return s
+        return select_heads(self.unshared, h, d)
 
 
 class Discriminator(nn.Module):
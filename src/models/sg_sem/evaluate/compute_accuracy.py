@@ -4,22 +4,25 @@ import torch
 from ..model import Generator, MappingNetwork, semantics
 import torchvision.utils as vutils
 from common.loaders import images
+from common.loaders.labels import LabelStore
 from common.initialize import get_last_model
 import torch.nn.functional as F
 from common.initialize import define_last_model
 from common.util import normalize
 
 
-def evaluate(loader, nz, domain, sem, mapping, generator, classifier, device):
+def evaluate(loader, nz, domain, labels, mapping, generator, classifier, device):
     correct = 0
     total = 0
+    offset = 0
 
     for data, label in loader:
         data = data*2 - 1
         N = len(data)
         d_trg = torch.tensor(domain).repeat(N).long().to(device)
         data, label = data.to(device), label.to(device)
-        y = sem((data+1)*0.5).argmax(1)
+        y = labels[offset:offset+N].to(device)
+        offset += N
 
         z = torch.randn(N, nz).to(device)
         s = mapping(z, y, d_trg)
@@ -81,16 +84,18 @@ def execute(args):
     mapping.load_state_dict(state_dict['mapping_network'])
     mapping.to(device)
 
-    sem = semantics(None, 'vmt_cluster', args.da_path, shape=[3, 32], nc=10).cuda()
+    ss_path = None  # vmt_cluster has no self-supervised model
+    sem = semantics(ss_path, 'vmt_cluster', args.da_path, shape=[3, 32], nc=10).cuda()
     sem.eval()
 
     classifier = define_last_model('classifier', args.classifier_path, 'classifier', shape=3, nc=10).to(device)
     classifier.eval()
 
     dataset = getattr(images, args.dataset_src)
-    src_dataset = dataset(data_root_src, 1, 32)[2]
+    src_dataset = dataset(data_root_src, 1, 32, splits=('test',))[2]
+    labels, _ = images.infer_labels(src_dataset.dataset, sem, device, store=LabelStore(args.da_path, ss_path))
 
-    accuracy = evaluate(src_dataset, nz, domain, sem, mapping, generator, classifier, device)
+    accuracy = evaluate(src_dataset, nz, domain, labels, mapping, generator, classifier, device)
     print(accuracy)
 
     save_result(save_path, args.identifier, state_dict_path, accuracy)
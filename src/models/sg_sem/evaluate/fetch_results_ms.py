@@ -42,7 +42,7 @@ def execute(args):
     sem.eval()
 
     dataset = getattr(images, args.dataset_src)
-    src_dataset = dataset(args.data_root_src, 1, N)[2]
+    src_dataset = dataset(args.data_root_src, 1, N, splits=('test',))[2]
 
     data, labels = next(iter(src_dataset))
     data = data.to(device)
@@ -75,6 +75,7 @@ def execute(args):
 
     N = 10
     R = 5
+    h = generator.content(data[:N])
     data = torch.cat([data[:N]]*R, 0)
     y_trg = torch.cat([y_src[:N]]*R, 0)
     d_trg = torch.tensor(domain).repeat(N*R).long().to(device)
@@ -83,7 +84,7 @@ def execute(args):
     z_trg = torch.cat(z_trg, 0)
     print(z_trg.shape, y_trg.shape, d_trg.shape)
     s_trg = mapping(z_trg, y_trg, d_trg)
-    x_fake = generator(data, s_trg)
+    x_fake = generator.stylize(h, s_trg)
     x_concat = torch.cat((data[:N], x_fake), 0)
     save_image(x_concat, 10, f'{name}_z.png')
 
@@ -5,6 +5,7 @@ from torch.utils import data
 from common.util import normalize, get_args
 from common.initialize import get_last_model
 from common.loaders import images
+from common.loaders.labels import LabelStore
 from common.evaluation import fid
 
 
@@ -35,6 +36,7 @@ def execute(args):
     device = 'cuda'
     latent_dim = 16
     batch_size = 128
+    n_styles = 20
     # Load model
     save_path = args.save_path
     state_dict_path = get_last_model('nets_ema', save_path)
@@ -51,7 +53,9 @@ def execute(args):
     sem.eval()
 
     dataset = getattr(images, args.dataset_src)(args.data_root_src)
-    src = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=10)
+    store = LabelStore(args.da_path, args.ss_path)
+    labels, _ = images.infer_labels(dataset, sem, device, batch_size, store=store)
+    src = torch.utils.data.DataLoader(dataset, batch_size=batch_size // n_styles, num_workers=10)
     dataset = getattr(images, args.dataset_tgt)(args.data_root_tgt)
     trg = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=10)
 
@@ -59,15 +63,17 @@ def execute(args):
     generated = []
     #print('Fetching generated data')
     d = torch.tensor(args.domain).repeat(batch_size).long().to(device)
+    offset = 0
     for data in src:
         data = data.to(device)
-        d_trg = d[:data.shape[0]]
-        y_trg = sem((data+1)*0.5).argmax(1)
-        for i in range(20):
-            z_trg = torch.randn(data.shape[0], latent_dim, device=device)
-            s_trg = mapping(z_trg, d_trg)
-            gen = generator(data, s_trg)
-            generated.append(gen)
+        y_trg = labels[offset:offset+data.shape[0]].to(device)
+        offset += data.shape[0]
+        # Encoded once and decoded with all its styles in one pass of about batch_size images
+        h = generator.content(data)
+        z_trg = torch.randn(n_styles * data.shape[0], latent_dim, device=device)
+        s_trg = mapping(z_trg, d[:z_trg.shape[0]])
+        gen = generator.stylize(h, s_trg)
+        generated.append(gen)
     generated = torch.cat(generated)
     generated = normalize(generated)
     #save_image(generated[:4], 'Debug.png')
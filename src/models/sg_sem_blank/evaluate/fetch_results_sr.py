@@ -57,6 +57,7 @@ def execute(args):
     d_trg = torch.tensor(domain).repeat(25).long().to(device)
     z_trg = torch.cat(5*[torch.randn(1, 5, latent_dim)]).to(device)
     z_trg = z_trg.transpose(0,1).reshape(25, latent_dim)
+    h = generator.content(data)
     data = torch.cat(5*[data])
     y_src = torch.cat(5*[y_src])
     print(z_trg.shape, data.shape, y_src.shape)
@@ -67,7 +68,7 @@ def execute(args):
     print(z_trg.shape, y_src.shape, d_trg.shape)
     s_trg = mapping(z_trg, d_trg)
     print(data.shape, s_trg.shape)
-    x_fake = generator(data, s_trg)
+    x_fake = generator.stylize(h, s_trg)
     x_concat += [x_fake]
 
     x_concat = torch.cat(x_concat, dim=0)
@@ -20,11 +20,12 @@ def evaluate(loader, nz, domain, sem, mapping, generator, classifier, device):
         d_trg = torch.tensor(domain).repeat(N).long().to(device)
         data, label = data.to(device), label.to(device)
         y = sem((data+1)*0.5)
+        h = generator.content(data)
 
         for i in range(10):
             z = torch.randn(N, nz).to(device)
             s = mapping(z, y, d_trg)
-            gen = generator(data, s)
+            gen = generator.stylize(h, s)
 
             gen = normalize(gen)
             save_image(normalize(data), 'data.png')
@@ -98,7 +99,7 @@ def execute(args):
     classifier.eval()
 
     dataset = getattr(images, args.dataset_src)
-    src_dataset = dataset(data_root_src, 1, 32)[2]
+    src_dataset = dataset(data_root_src, 1, 32, splits=('test',))[2]
 
     accuracy = evaluate(src_dataset, nz, domain, sem, mapping, generator, classifier, device)
     print(accuracy)
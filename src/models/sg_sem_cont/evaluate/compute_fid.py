@@ -35,6 +35,7 @@ def execute(args):
     device = 'cuda'
     latent_dim = 16
     batch_size = 128
+    n_styles = 15
     # Load model
     save_path = args.save_path
     state_dict_path = get_last_model('nets_ema', save_path)
@@ -54,7 +55,7 @@ def execute(args):
     sem.eval()
 
     dataset = getattr(images, args.dataset_src)(args.data_root_src)
-    src = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=10)
+    src = torch.utils.data.DataLoader(dataset, batch_size=batch_size // n_styles, num_workers=10)
     dataset = getattr(images, args.dataset_tgt)(args.data_root_tgt)
     trg = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=10)
 
@@ -64,13 +65,13 @@ def execute(args):
     d = torch.tensor(args.domain).repeat(batch_size).long().to(device)
     for data in src:
         data = data.to(device)
-        d_trg = d[:data.shape[0]]
         y_trg = sem((data+1)*0.5)
-        for i in range(15):
-            z_trg = torch.randn(data.shape[0], latent_dim, device=device)
-            s_trg = mapping(z_trg, y_trg, d_trg)
-            gen = generator(data, s_trg)
-            generated.append(gen)
+        # Encoded once and decoded with all its styles in one pass of about batch_size images
+        h = generator.content(data)
+        z_trg = torch.randn(n_styles * data.shape[0], latent_dim, device=device)
+        s_trg = mapping(z_trg, torch.cat(n_styles*[y_trg]), d[:z_trg.shape[0]])
+        gen = generator.stylize(h, s_trg)
+        generated.append(gen)
     generated = torch.cat(generated)
     generated = normalize(generated)
     #save_image(generated[:4], 'Debug.png')
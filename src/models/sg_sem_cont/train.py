@@ -15,6 +15,11 @@ import torchvision.utils as vutils
 
 from .model import build_model, semantics
 from common.initialize import infer_iteration
+from common.loaders import timing
+from common.precision import autocast
+from common.flat import flatten, flat_parameters, adam
+from common.loaders.prefetch import Prefetcher
+from common.loaders.resume import resumable, advance
 
 
 class Solver(nn.Module):
@@ -33,24 +38,14 @@ class Solver(nn.Module):
         for name, module in self.nets_ema.items():
             setattr(self, name + '_ema', module)
 
-        self.optims = Munch()
-        for net in self.nets.keys():
-            self.optims[net] = torch.optim.Adam(
-                params=self.nets[net].parameters(),
-                lr=args.f_lr if net == 'mapping_network' else args.lr,
-                betas=[args.beta1, args.beta2],
-                weight_decay=args.weight_decay)
-
-        self.ckptios = [
-            CheckpointIO(ospj(args.model_path, 'nets:{:06d}.ckpt'), **self.nets),
-            CheckpointIO(ospj(args.model_path, 'nets_ema:{:06d}.ckpt'), **self.nets_ema),
-            CheckpointIO(ospj(args.model_path, 'optims:{:06d}.ckpt'), **self.optims)]
-
         cont_repr = semantics(args.sem_type, args.sem_path)
         cont_repr = cont_repr.to(args.device)
         cont_repr.eval()
         self.cont_repr = cont_repr
 
+        # bfloat16 forward passes and losses with fp32 weights
+        self.autocast = autocast(args.bf16, args.device)
+
         self.to(self.device)
         for name, network in self.named_children():
             # Do not initialize the EMA parameters
@@ -58,6 +53,24 @@ class Solver(nn.Module):
                 print('Initializing %s...' % name)
                 network.apply(he_init)
 
+        # The networks with an EMA are held in flat buffers, for one EMA update and one Adam step per network
+        for name in self.nets_ema.keys():
+            flatten(self.nets[name])
+            flatten(self.nets_ema[name])
+
+        self.optims = Munch()
+        for net in self.nets.keys():
+            self.optims[net] = adam(
+                self.nets[net],
+                lr=args.f_lr if net == 'mapping_network' else args.lr,
+                betas=[args.beta1, args.beta2],
+                weight_decay=args.weight_decay)
+
+        self.ckptios = [
+            CheckpointIO(ospj(args.model_path, 'nets:{:06d}.ckpt'), **self.nets),
+            CheckpointIO(ospj(args.model_path, 'nets_ema:{:06d}.ckpt'), **self.nets_ema),
+            CheckpointIO(ospj(args.model_path, 'optims:{:06d}.ckpt'), **self.optims)]
+
     def _save_checkpoint(self, step, checkpoint):
         for ckptio in self.ckptios:
             ckptio.save(step, checkpoint)
@@ -66,6 +79,17 @@ class Solver(nn.Module):
         for ckptio in self.ckptios:
             ckptio.load(step)
 
+    def _resume_sampler(self, loader, step):
+        # The order of the training batches is saved with the checkpoints (see common.loaders.resume)
+        sampler = resumable(loader)
+        if sampler is None:
+            return
+        ckptio = CheckpointIO(ospj(self.args.model_path, 'sampler:{:06d}.ckpt'), src=sampler)
+        # Checkpoints saved without the sampler restart the data order
+        if step > 0 and os.path.exists(ckptio.fname_template.format(step)):
+            ckptio.load(step)
+        self.ckptios.append(ckptio)
+
     def _reset_grad(self):
         for optim in self.optims.values():
             optim.zero_grad()
@@ -76,24 +100,28 @@ class Solver(nn.Module):
         nets_ema = self.nets_ema
         optims = self.optims
 
+        # resume training if necessary (the checkpoints are saved after `step` iterations)
+        resume_iter = args.resume_iter or max(
+            infer_iteration('nets', args.reload, args.model_path, args.save_path) - 1, 0)
+        if resume_iter > 0:
+            self._load_checkpoint(resume_iter)
+        self._resume_sampler(loaders.src, resume_iter)
+
+        timing.reset()  # Discards the timings of the dataset setup
         # fetch random validation images for debugging
-        fetcher = InputFetcher(loaders.src, args.latent_dim, args.device)
+        fetcher = Prefetcher(InputFetcher(loaders.src, args.latent_dim, args.device), args.prefetch)
         fetcher_val = InputFetcher(loaders.val, args.latent_dim, args.device)
         inputs_val = next(fetcher_val)
 
-        # resume training if necessary
-        resume_iter = infer_iteration('nets', args.reload, args.model_path, args.save_path)
-        print(resume_iter)
-        if args.resume_iter > 0:
-            self._load_checkpoint(resume_iter)
-
         # remember the initial value of ds weight
         print('Start training...')
         start_time = time.time()
+        log_time, log_iter = start_time, resume_iter
         for i in range(resume_iter, args.total_iters):
             lambda_ds = args.lambda_ds * (1 - i / args.total_iters)
             # fetch images and labels
             inputs = next(fetcher)
+            advance(loaders.src)
             x_real, d_org = inputs.x_src, inputs.d_src
             x_trg, x_ds, d_trg = inputs.x_src2, inputs.x_ds, inputs.d_src2
             z_trg, z_trg2 = inputs.z_trg, inputs.z_trg2
@@ -101,43 +129,57 @@ class Solver(nn.Module):
                 f_real = self.cont_repr((x_real + 1) / 2)
 
             # train the discriminator
-            d_loss, d_losses_latent = compute_d_loss(
-                nets, args, x_real, f_real, d_org, d_trg, z_trg=z_trg)
+            with self.autocast:
+                d_loss, d_losses_latent = compute_d_loss(
+                    nets, args, x_real, f_real, d_org, d_trg, z_trg=z_trg,
+                    reg=(2*i) % args.r1_every == 0)
             self._reset_grad()
             d_loss.backward()
             optims.discriminator.step()
 
-            d_loss, d_losses_ref = compute_d_loss(
-                nets, args, x_real, f_real, d_org, d_trg, x_trg=x_trg)
+            with self.autocast:
+                d_loss, d_losses_ref = compute_d_loss(
+                    nets, args, x_real, f_real, d_org, d_trg, x_trg=x_trg,
+                    reg=(2*i+1) % args.r1_every == 0)
             self._reset_grad()
             d_loss.backward()
             optims.discriminator.step()
 
             # train the generator
-            g_loss, g_losses_latent = compute_g_loss(
-                nets, self.cont_repr, args, x_real, f_real, d_org, d_trg, lambda_ds, z_trgs=[z_trg, z_trg2])
+            with self.autocast:
+                g_loss, g_losses_latent = compute_g_loss(
+                    nets, self.cont_repr, args, x_real, f_real, d_org, d_trg, lambda_ds, z_trgs=[z_trg, z_trg2])
             self._reset_grad()
             g_loss.backward()
             optims.generator.step()
             optims.mapping_network.step()
             optims.style_encoder.step()
 
-            g_loss, g_losses_ref = compute_g_loss(
-                nets, self.cont_repr, args, x_real, f_real, d_org, d_trg, lambda_ds, x_refs=[x_trg, x_ds])
+            with self.autocast:
+                g_loss, g_losses_ref = compute_g_loss(
+                    nets, self.cont_repr, args, x_real, f_real, d_org, d_trg, lambda_ds, x_refs=[x_trg, x_ds])
             self._reset_grad()
             g_loss.backward()
             optims.generator.step()
 
-            # compute moving average of network parameters
-            moving_average(nets.generator, nets_ema.generator, beta=0.999)
-            moving_average(nets.mapping_network, nets_ema.mapping_network, beta=0.999)
-            moving_average(nets.style_encoder, nets_ema.style_encoder, beta=0.999)
+            # compute moving average of network parameters, with the decay of ema_every iterations
+            if (i+1) % args.ema_every == 0:
+                beta = 0.999 ** args.ema_every
+                moving_average(nets.generator, nets_ema.generator, beta=beta)
+                moving_average(nets.mapping_network, nets_ema.mapping_network, beta=beta)
+                moving_average(nets.style_encoder, nets_ema.style_encoder, beta=beta)
 
             # print out log info
             if (i+1) % args.print_every == 0:
-                elapsed = time.time() - start_time
+                now = time.time()
+                throughput = (i+1 - log_iter) / (now - log_time)
+                log_time, log_iter = now, i+1
+                args.visualiser.plot(throughput, title='Throughput (it/s)', step=i+1)
+                elapsed = now - start_time
                 elapsed = str(datetime.timedelta(seconds=elapsed))[:-7]
-                log = "Elapsed time [%s], Iteration [%i/%i], " % (elapsed, i+1, args.total_iters)
+                log = "Elapsed time [%s], Data wait [%.1fs], Throughput [%.2f it/s], Iteration [%i/%i], " % (
+                    elapsed, fetcher.wait_time, throughput, i+1, args.total_iters)
+                log += timing.report(args.visualiser, i+1)
                 all_losses = dict()
                 for loss, prefix in zip([d_losses_latent, d_losses_ref, g_losses_latent, g_losses_ref],
                                         ['D/latent_', 'D/ref_', 'G/latent_', 'G/ref_']):
@@ -154,14 +196,15 @@ class Solver(nn.Module):
             # save model checkpoints
             if (i+1) % args.save_every == 0:
                 self._save_checkpoint(step=i+1, checkpoint=args.checkpoint)
+        fetcher.close()
 
 
-def compute_d_loss(nets, args, x_real, f_real, d_org, d_trg, z_trg=None, x_trg=None):
-    # with real images
-    x_real.requires_grad_()
+def compute_d_loss(nets, args, x_real, f_real, d_org, d_trg, z_trg=None, x_trg=None, reg=True):
+    # with real images, R1 only on the regularized D steps (lazy regularization, see --r1_every)
+    x_real = x_real.detach().requires_grad_(reg)
     out = nets.discriminator(x_real, d_org)
     loss_real = adv_loss(out, 1)
-    loss_reg = r1_reg(out, x_real)
+    loss_reg = r1_reg(out, x_real) if reg else torch.zeros_like(loss_real)
 
     # with fake images
     with torch.no_grad():
@@ -174,7 +217,7 @@ def compute_d_loss(nets, args, x_real, f_real, d_org, d_trg, z_trg=None, x_trg=N
     out = nets.discriminator(x_fake, d_trg)
     loss_fake = adv_loss(out, 0)
 
-    loss = loss_real + loss_fake + args.lambda_reg * loss_reg
+    loss = loss_real + loss_fake + args.lambda_reg * args.r1_every * loss_reg
     return loss, Munch(real=loss_real.item(),
                        fake=loss_fake.item(),
                        reg=loss_reg.item())
@@ -193,7 +236,9 @@ def compute_g_loss(nets, f_net, args, x_real, f_real, d_org, d_trg, lambda_ds, z
     else:
         s_trg = nets.style_encoder(x_ref, f_real, d_trg)
 
-    x_fake = nets.generator(x_real, s_trg)
+    # the content of the real images is shared with the diversity branch
+    h_real = nets.generator.content(x_real)
+    x_fake = nets.generator.stylize(h_real, s_trg)
     out = nets.discriminator(x_fake, d_trg)
     loss_adv = adv_loss(out, 1)
 
@@ -210,7 +255,8 @@ def compute_g_loss(nets, f_net, args, x_real, f_real, d_org, d_trg, lambda_ds, z
         s_trg2 = nets.mapping_network(z_trg2, f_real, d_trg)
     else:
         s_trg2 = nets.style_encoder(x_ds, f_real, d_trg)
-    x_fake2 = nets.generator(x_real, s_trg2).detach()
+    with torch.no_grad():
+        x_fake2 = nets.generator.stylize(h_real, s_trg2)
     loss_ds = torch.mean(torch.abs(x_fake - x_fake2))
 
     # cycle-consistency loss
@@ -229,8 +275,12 @@ def compute_g_loss(nets, f_net, args, x_real, f_real, d_org, d_trg, lambda_ds, z
 
 
 def moving_average(model, model_test, beta=0.999):
+    flat, flat_test = flat_parameters(model), flat_parameters(model_test)
+    if flat is not None and flat_test is not None:
+        flat_test.lerp_(flat, 1 - beta)
+        return
     for param, param_test in zip(model.parameters(), model_test.parameters()):
-        param_test.data = torch.lerp(param.data, param_test.data, beta)
+        param_test.data.lerp_(param.data, 1 - beta)
 
 
 def adv_loss(logits, target):
@@ -274,7 +324,6 @@ def he_init(module):
 @torch.no_grad()
 def debug_image(nets, args, inputs, step):
     x_src, d_src, y_src = inputs.x_src,  inputs.d_src, inputs.y_src
-    x_ref, d_ref        = inputs.x_src2, inputs.d_src2
 
     device = inputs.x_src.device
     N = inputs.x_src.size(0)
@@ -292,11 +341,12 @@ def debug_image(nets, args, inputs, step):
 def translate_using_latent(nets, args, x_src, y_src, d_trg_list, z_trg_list, psi, filename):
     N, C, H, W = x_src.size()
     x_concat = [x_src]
+    h_src = nets.generator.content(x_src)
 
     for i, d_trg in enumerate(d_trg_list):
         for z_trg in z_trg_list:
             s_trg = nets.mapping_network(z_trg, y_src, d_trg)
-            x_fake = nets.generator(x_src, s_trg)
+            x_fake = nets.generator.stylize(h_src, s_trg)
             x_concat += [x_fake]
 
     x_concat = torch.cat(x_concat, dim=0)
@@ -348,11 +398,12 @@ class InputFetcher:
         self.device = device
 
     def _fetch_inputs(self):
-        try:
-            x, y, d, x2, x_ds, d2 = next(self.iter)
-        except (AttributeError, StopIteration):
-            self.iter = iter(self.loader)
-            x, y, d, x2, x_ds, d2 = next(self.iter)
+        with timing.stage('wait'):
+            try:
+                x, y, d, x2, x_ds, d2 = next(self.iter)
+            except (AttributeError, StopIteration):
+                self.iter = iter(self.loader)
+                x, y, d, x2, x_ds, d2 = next(self.iter)
         return x, y, d, x2, x_ds, d2
 
     def __next__(self):
@@ -363,5 +414,8 @@ class InputFetcher:
                        x_ds=x_ds, d_src2=d2, d_src=d,
                        z_trg=z_trg, z_trg2=z_trg2)
 
+        if x2.dim() == 1:
+            # Lazy loaders (validation) only load the anchors: the partners are given by their indices
+            inputs.idx_src2, inputs.idx_ds = inputs.pop('x_src2'), inputs.pop('x_ds')
         return Munch({k: v.to(self.device)
                       for k, v in inputs.items()})
@@ -42,7 +42,7 @@ def execute(args):
     sem.eval()
 
     dataset = getattr(images, args.dataset_src)
-    src_dataset = dataset(args.data_root_src, 1, N)[2]
+    src_dataset = dataset(args.data_root_src, 1, N, splits=('test',))[2]
 
     data, labels = next(iter(src_dataset))
     data = data.to(device)
@@ -6,7 +6,7 @@ from torch import optim
 
 from common.util import sample, save_models
 #from evaluation.fid import calculate_fid
-from common.initialize import initialize, infer_iteration
+from common.initialize import initialize, infer_iteration, resume_samplers
 from . import model
 
 
@@ -119,6 +119,8 @@ def train(args):
     optim_critic = optim.Adam(critic.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
     optim_generator = optim.Adam(generator.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
 
+    samplers = resume_samplers({'sampler1': train_loader1, 'sampler2': train_loader2}, args.reload, args.save_path,
+                               args.model_path)
     iter1 = iter(train_loader1)
     iter2 = iter(train_loader2)
     iteration = infer_iteration(list(models.keys())[0], args.reload, args.model_path, args.save_path)
@@ -168,6 +170,7 @@ def train(args):
             args.visualiser.plot(test_accuracy_xy, title=f'Test transfer accuracy X-Y', step=i)
             t0 = time.time()
             save_models(models, 0, args.model_path, args.checkpoint)
+            save_models(samplers, 0, args.model_path, args.checkpoint)
 
 
 @torch.no_grad()
@@ -4,7 +4,7 @@ import torch.nn.functional as F
 from torch import optim
 
 from common.util import sample, save_models, one_hot_embedding
-from common.initialize import initialize, infer_iteration
+from common.initialize import initialize, infer_iteration, resume_samplers
 from . import model
 
 
@@ -215,6 +215,8 @@ def train(args):
     optim_classifier = optim.Adam(classifier.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
     optim_discriminator = optim.Adam(discriminator.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
 
+    samplers = resume_samplers({'sampler1': train_loader1, 'sampler2': train_loader2}, args.reload, args.save_path,
+                               args.model_path)
     iter1 = iter(train_loader1)
     iter2 = iter(train_loader2)
     titer1 = iter(test_loader1)
@@ -272,3 +274,4 @@ def train(args):
             args.visualiser.plot(c_loss.cpu().detach().numpy(), title=f'Classifier loss', step=i)
             t0 = time.time()
             save_models(models, i, args.model_path, args.checkpoint)
+            save_models(samplers, i, args.model_path, args.checkpoint)